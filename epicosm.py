@@ -2,16 +2,16 @@
 
 import os
 import sys
-import glob
 import argparse
 import time
 import datetime
 import subprocess
 import signal
+import threading
 import schedule
 
 # from ./modules
-from modules import mongo_ops, epicosm_meta, twitter_ops, env_config, mongodb_config
+from modules import mongo_ops, epicosm_meta, twitter_ops, env_config, mongodb_config, network_ops, work_leases, harvest_metrics, harvest_planner, db_migrations, backup_ops
 
 
 def args_setup():
@@ -22,10 +22,44 @@ def args_setup():
       help="Harvest tweets from all users from a file called user_list (provided by you) with a single user per line.")
     parser.add_argument("--get_friends", action="store_true",
       help="Create a database of the users that are being followed by the accounts in your user_list. (This process can be very slow, especially if your users are prolific followers.)")
+    parser.add_argument("--with_friends", action="store_true",
+      help="With --harvest and --get_friends, gather friend lists at the same time as timelines rather than afterwards. The two use separate rate limits, so this takes about as long as the slower of the two.")
+    parser.add_argument("--friend_edges", action="store_true",
+      help="With --get_friends, also keep each follow as its own document in the friend_edges collection, and export the follow graph as a sparse matrix for network analysis.")
+    parser.add_argument("--cofollow", action="store_true",
+      help="Analyse the stored friend lists: find the accounts most followed by your users, and for each user the users whose follows are most like theirs. Results go to the cofollowed_accounts and cofollow_similarity collections.")
     parser.add_argument("--repeat", action="store_true",
       help="Repeat the harvest every 72 hours. This process will need to be put to the background to free your terminal prompt.")
+    parser.add_argument("--workers", type=int, default=1,
+      help="Number of users to harvest concurrently (default 1). All workers share the API rate limits, so more workers only help until the request budget is used up.")
+    parser.add_argument("--batch_size", type=int, default=1000,
+      help="Number of tweets written to MongoDB in each bulk insert (default 1000).")
+    parser.add_argument("--write_concern", default=None,
+      help="MongoDB write concern for tweet inserts, eg 1 or majority (default: the server's own default).")
+    parser.add_argument("--full_cycle", action="store_true",
+      help="Request every user's timeline, rather than skipping users who have not posted since the last harvest.")
+    parser.add_argument("--raw_json", action="store_true",
+      help="Fetch timelines as plain JSON, skipping tweepy's tweet objects. Faster for large harvests, especially with the optional orjson package installed.")
+    parser.add_argument("--keep_alive", action="store_true",
+      help="Send API requests over a shared pool of kept-alive, gzip-compressed connections (one per worker) instead of a new connection for every request.")
+    parser.add_argument("--distributed", action="store_true",
+      help="Share the harvest with other Epicosm processes using the same database. Each process claims batches of users in turn, and batches from a process that dies are picked up by the others.")
+    parser.add_argument("--adaptive", action="store_true",
+      help="Instead of harvesting everyone at once, poll each user at an interval suited to how often they post, continuously for three days at a time. Use with --repeat to keep going.")
+    parser.add_argument("--daemon", action="store_true",
+      help="Run as a long-lived harvester: set up once, then harvest every three days (or continuously with --adaptive), reusing connections and state between cycles. Stops cleanly on SIGTERM or ctrl-c.")
+    parser.add_argument("--metrics_port", type=int, default=None,
+      help="Serve live harvest metrics (request latencies, retries, bytes, rate limit waits, tweets fetched and inserted) as JSON at http://localhost:PORT/metrics.")
+    parser.add_argument("--plan", action="store_true",
+      help="Estimate how many requests and how long the first harvest, each later cycle and friends gathering will take, from what is already stored about your users, your number of credential sets and --workers. Nothing is harvested.")
     parser.add_argument("--refresh", action="store_true",
       help="If you have a new user_list, this will tell Epicosm to switch to this list.")
+    parser.add_argument("--full_backup", action="store_true",
+      help="Make this run's backup a full snapshot of the database, rather than only what is new since the last backup.")
+    parser.add_argument("--db_cache_gb", type=float, default=None,
+      help="Size of MongoDB's WiredTiger cache in GB, when Epicosm starts MongoDB (default: half of RAM less 1GB).")
+    parser.add_argument("--journal_commit_ms", type=int, default=None,
+      help="Milliseconds between MongoDB journal commits, 1 to 500, when Epicosm starts MongoDB (default 100).")
     parser.add_argument("--start_db", action="store_true",
       help="Start the MongoDB daemon in this folder, but don't run any Epicosm processes.")
     parser.add_argument("--stop", action="store_true",
@@ -38,6 +72,98 @@ def args_setup():
     return parser, args
 
 
+def backup_and_rotate(env):
+
+    """Back up the database, incrementally (see backup_ops), and remove backups
+    older than the last two full snapshots."""
+
+    backup_ops.backup(mongodb_config.db, env.backup_path, full=args.full_backup)
+    backup_ops.rotate(env.backup_path)
+
+
+def daemon():
+
+    """Run as a long-lived harvester.
+
+    Setup happens once: MongoDB is started, credentials verified and the user
+    list resolved, and the same credential pool and MongoClient are used for
+    the daemon's whole life. Each cycle then only does the incremental work:
+    the user list is looked up again only if user_list has changed, then
+    users are harvested and the database backed up. A cycle is three days,
+    either as one harvest (then idle) or, with --adaptive, polling users as
+    they fall due. SIGTERM or ctrl-c stops harvests at their next request,
+    leaving the run to be resumed, then stops MongoDB (if the daemon started
+    it) and exits."""
+
+    env = env_config.EnvironmentConfig()
+    epicosm_meta.native_or_compiled()
+    (mongod_executable_path, mongoexport_executable_path,
+    mongodump_executable_path, screen_names) = epicosm_meta.check_env()
+    mongo_ops.start_mongo(mongod_executable_path,
+                          env.db_path,
+                          env.db_log_filename,
+                          env.epicosm_log_filename)
+    credentials, auth, api = twitter_ops.get_credentials(args.workers + 2 if args.keep_alive else None)
+    epicosm_meta.logger_setup(env.epicosm_log_filename)
+    mongo_ops.index_mongo(env.run_folder)
+    if args.metrics_port:
+        harvest_metrics.serve(harvest_metrics.process_metrics, args.metrics_port)
+
+    stop = threading.Event()
+    api.stop = stop # so requests waiting for rate limits give up too
+
+    def drain(sig, frame):
+        print(f"Signal {sig} received, stopping harvests in progress...")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, drain)
+    signal.signal(signal.SIGINT, drain)
+
+    leases = work_leases.WorkLeases(mongodb_config.db) if args.distributed else None
+    harvest_options = dict(workers=args.workers, batch_size=args.batch_size,
+                           write_concern=args.write_concern, full_cycle=args.full_cycle,
+                           raw_json=args.raw_json, leases=leases)
+    user_list_mtime = None
+    users_to_follow = None
+
+    while not stop.is_set():
+        cycle_env = env_config.EnvironmentConfig() # fresh timestamps for this cycle's files
+        cycle_end = datetime.datetime.utcnow() + datetime.timedelta(days=3)
+
+        # only look users up again when the user list has been edited
+        mtime = os.path.getmtime(env.run_folder + "/user_list")
+        if mtime != user_list_mtime or users_to_follow is None:
+            if user_list_mtime is not None or args.refresh or not os.path.exists(env.run_folder + "/user_list.ids"):
+                screen_names = epicosm_meta.read_screen_names(env.run_folder)
+                twitter_ops.lookup_users(env.run_folder, screen_names, credentials, auth, api, args,
+                                         mongodb_config.screen_name_collection)
+            users_to_follow = [int(line.rstrip("\n")) for line in open(env.run_folder + "/user_list.ids")]
+            user_list_mtime = mtime
+
+        epicosm_meta.status_up(env.status_file)
+        if args.adaptive:
+            twitter_ops.harvest_adaptive(env.run_folder, credentials, auth, api,
+                                         mongodb_config.client, mongodb_config.db, mongodb_config.collection,
+                                         cycle_end, users_to_follow, stop, **harvest_options)
+        else:
+            twitter_ops.harvest(env.run_folder, credentials, auth, api,
+                                mongodb_config.client, mongodb_config.db, mongodb_config.collection,
+                                users_to_follow=users_to_follow, stop=stop, **harvest_options)
+        db_migrations.print_index_usage(mongodb_config.db)
+        if not stop.is_set(): # when draining, leave the backup to the next start
+            backup_and_rotate(cycle_env)
+        epicosm_meta.status_down(env.status_file, env.run_folder)
+        print(f"Daemon cycle finished at {datetime.datetime.now().strftime('%Y-%m-%d_%H:%M:%S')}.\n")
+
+        stop.wait(max(0, (cycle_end - datetime.datetime.utcnow()).total_seconds()))
+
+    print(f"Harvests drained, stopping.")
+    if mongo_ops.mongod_process is not None: # a mongod already running may be shared with other processes
+        mongo_ops.stop_mongo(env.db_path)
+    else:
+        mongodb_config.close()
+
+
 def main():
 
     # Set paths as instance of EnvironmentConfig
@@ -73,30 +199,74 @@ def main():
         print(f"OK, MongoDB started, but without Epicosm processes.")
         sys.exit(0)
 
+    # estimate the harvest, without making it
+    if args.plan:
+        credential_sets = len(twitter_ops.read_credentials())
+
+        def plan(credentials):
+            return harvest_planner.plan(env.run_folder, mongodb_config.db, screen_names,
+                                        credentials, args.workers, full_cycle=args.full_cycle)
+
+        harvest_planner.print_plan(plan(credential_sets), credential_sets, args.workers, plan)
+        sys.exit(0)
+
     # verify credentials
-    credentials, auth, api = twitter_ops.get_credentials()
+    credentials, auth, api = twitter_ops.get_credentials(args.workers + 2 if args.keep_alive else None)
 
     # set up logging
     epicosm_meta.logger_setup(env.epicosm_log_filename)
 
+    # live metrics, if asked for
+    if args.metrics_port:
+        harvest_metrics.serve(harvest_metrics.process_metrics, args.metrics_port)
+
     # setup signal handler
     signal.signal(signal.SIGINT, epicosm_meta.signal_handler)
 
     # modify status file
     epicosm_meta.status_up(env.status_file)
 
-    # tidy up the database for better efficiency
+    # build any indexes the database is missing (per-user ones in the background)
     mongo_ops.index_mongo(env.run_folder)
 
     # get persistent user ids from screen names
     if args.refresh or not os.path.exists(env.run_folder + "/user_list.ids"):
-        twitter_ops.lookup_users(env.run_folder, screen_names, credentials, auth, api, args)
+        twitter_ops.lookup_users(env.run_folder, screen_names, credentials, auth, api, args,
+                                mongodb_config.screen_name_collection)
 
     # get tweets for each user and archive in mongodb
+    harvest_options = dict(workers=args.workers, batch_size=args.batch_size,
+                           write_concern=args.write_concern, full_cycle=args.full_cycle,
+                           raw_json=args.raw_json)
+
+    def friend_edges():
+        # looked up on each use, as MongoDB may have been restarted (and the client made again) since
+        return mongodb_config.friend_edges_collection if args.friend_edges else None
+
+    # friends alongside timelines, unless friends are already done or the harvest never ends
+    with_friends = args.with_friends and args.harvest and args.get_friends and not args.adaptive
+
+    def run_harvest():
+        harvest_options["leases"] = work_leases.WorkLeases(mongodb_config.db) if args.distributed else None
+        if args.adaptive: # poll users as they fall due until the next scheduled backup
+            twitter_ops.harvest_adaptive(env.run_folder, credentials, auth, api,
+                                         mongodb_config.client, mongodb_config.db, mongodb_config.collection,
+                                         datetime.datetime.utcnow() + datetime.timedelta(days=3),
+                                         **harvest_options)
+        elif with_friends:
+            twitter_ops.harvest_with_friends(env.run_folder, credentials, auth, api,
+                                             mongodb_config.client, mongodb_config.db, mongodb_config.collection,
+                                             mongodb_config.friends_collection,
+                                             mongodb_config.friends_history_collection,
+                                             friend_edges(), **harvest_options)
+        else:
+            twitter_ops.harvest(env.run_folder, credentials, auth, api,
+                                mongodb_config.client, mongodb_config.db, mongodb_config.collection,
+                                **harvest_options)
+
     if args.harvest:
         try:
-            twitter_ops.harvest(env.run_folder, credentials, auth, api,
-                                mongodb_config.client, mongodb_config.db, mongodb_config.collection)
+            run_harvest()
         except: # catching db down issues
             print(f"Is the DB down? Trying to restart...")
             mongo_ops.stop_mongo(env.db_path)
@@ -104,35 +274,38 @@ def main():
                                   env.db_path,
                                   env.db_log_filename,
                                   env.epicosm_log_filename)
-            twitter_ops.harvest(env.run_folder, credentials, auth, api,
-                                mongodb_config.client, mongodb_config.db, mongodb_config.collection)
+            run_harvest()
 
     # if user wants the friend list, make it
     if args.get_friends:
-        twitter_ops.get_friends(env.run_folder, credentials, auth,
-                                api, mongodb_config.friends_collection)
+        if not with_friends: # otherwise they were gathered during the harvest
+            twitter_ops.get_friends(env.run_folder, credentials, auth,
+                                    api, mongodb_config.friends_collection,
+                                    mongodb_config.friends_history_collection, args.full_cycle,
+                                    friend_edges())
         sys.argv.remove("--get_friends") # we only want to do this once
         # create CSV file of users' friends list.
         mongo_ops.export_csv_friends(mongoexport_executable_path,
                                      env.csv_friends_filename,
                                      env.epicosm_log_filename)
+        # and the follow graph as a sparse adjacency matrix
+        if args.friend_edges:
+            network_ops.export_friend_graph(mongodb_config.friends_collection,
+                                            mongodb_config.friend_edges_collection,
+                                            env.network_filename)
+
+    # which accounts do users follow in common, and whose follows are alike
+    if args.cofollow:
+        network_ops.cofollow_analysis(mongodb_config.friends_collection,
+                                      mongodb_config.friend_edges_collection,
+                                      mongodb_config.cofollowed_collection,
+                                      mongodb_config.cofollow_similarity_collection)
 
-    # backup database into BSON
-    mongo_ops.backup_db(mongodump_executable_path,
-                        env.database_dump_path,
-                        env.epicosm_log_filename,
-                        env.processtime)
-
-    # rotate backups - if there are more than 3, remove the oldest one
-    current_backup_count = len([name for name in os.listdir(env.database_dump_path + "/twitter_db") if os.path.isfile(os.path.join(env.database_dump_path + "/twitter_db", name))])
-    # each backup is one bson and one json of metadata, so 6 = 3 backups.
-    if current_backup_count > 6:
-        print("Rotating backups.")
-        bu_list = glob.glob(env.database_dump_path + "/twitter_db/tweets*")
-        bu_list.sort()
-        # remove the oldest two, a bson and a json
-        subprocess.call(["rm", bu_list[0]])
-        subprocess.call(["rm", bu_list[1]])
+    # which indexes this run's queries used
+    db_migrations.print_index_usage(mongodb_config.db)
+
+    # backup what is new in the database since the last backup
+    backup_and_rotate(env)
 
     # modify status file
     epicosm_meta.status_down(env.status_file, env.run_folder)
@@ -144,7 +317,16 @@ if __name__ == "__main__":
 
     parser, args = args_setup()
 
-    if args.repeat:
+    # a connection per harvest worker, and some for the bulk writer, friends, index builds and bookkeeping
+    mongodb_config.configure(pool_size=args.workers + 8,
+                             cache_gb=args.db_cache_gb, journal_commit_ms=args.journal_commit_ms)
+
+    if args.daemon:
+        daemon()
+    elif args.repeat and args.adaptive:
+        while True: # each main() harvests continuously for three days, then backs up
+            main()
+    elif args.repeat:
         main()
         schedule.every(3).days.at("06:00").do(main)
         while True:
@@ -0,0 +1,135 @@
+import sys
+import time
+import argparse
+import resource
+import tempfile
+
+import psutil
+import pymongo
+
+from modules import fake_twitter, mongodb_config, rate_limit, twitter_ops
+
+
+def args_setup():
+
+    parser = argparse.ArgumentParser(description="Epidemiology of Cohort Social Media - harvest benchmark",
+                                     epilog="Example: python3 epicosm_bench.py --users 500 --workers 8 --latency 0.05")
+    parser.add_argument("--users", type=int, default=200,
+      help="Number of synthetic users in the cohort (default 200).")
+    parser.add_argument("--credentials", type=int, default=1,
+      help="Number of credential sets to pool, each with its own rate limits (default 1).")
+    parser.add_argument("--workers", type=int, default=4,
+      help="Harvest workers, as epicosm.py --workers (default 4).")
+    parser.add_argument("--batch_size", type=int, default=twitter_ops.DEFAULT_BATCH_SIZE,
+      help="Tweets per MongoDB bulk insert, as epicosm.py --batch_size.")
+    parser.add_argument("--raw_json", action="store_true",
+      help="Harvest timelines as plain JSON, as epicosm.py --raw_json.")
+    parser.add_argument("--latency", type=float, default=0.05,
+      help="Mean seconds each fake API request takes (default 0.05).")
+    parser.add_argument("--error_rate", type=float, default=0.0,
+      help="Share of fake API requests that fail with a 503 (default 0).")
+    parser.add_argument("--cycles", type=int, default=2,
+      help="Timeline harvests to run: the first is a deep harvest, and before each later one the fake clock moves on by --days (default 2).")
+    parser.add_argument("--days", type=float, default=3,
+      help="Days of new tweets between harvest cycles (default 3).")
+    parser.add_argument("--friends", type=int, default=10,
+      help="Users to gather friend lists for; friends requests are limited to 15 per 15 minutes per credential set (default 10).")
+    parser.add_argument("--database", default="epicosm_bench",
+      help="MongoDB database to harvest into; it is dropped before and after the run (default epicosm_bench).")
+    parser.add_argument("--seed", type=int, default=0,
+      help="Seed for the synthetic cohort (default 0).")
+
+    args = parser.parse_args()
+
+    return parser, args
+
+
+def measure(phase, service, collection, work):
+
+    """Run work() and report what it cost: wall time, requests, tweets and memory."""
+
+    before = service.stats()
+    stored_before = collection.estimated_document_count()
+    started = time.time()
+    work()
+    elapsed = max(time.time() - started, 1e-6)
+    after = service.stats()
+    stored = collection.estimated_document_count() - stored_before
+    requests = after["requests"] - before["requests"]
+    tweets = after["tweets"] - before["tweets"]
+    megabytes = (after["bytes"] - before["bytes"]) / 1e6
+    rss = psutil.Process().memory_info().rss / 1e6
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3 # kilobytes on linux
+    return {"phase": phase, "seconds": elapsed, "requests": requests,
+            "requests/s": requests / elapsed, "tweets fetched": tweets,
+            "tweets stored": stored, "tweets/s": stored / elapsed,
+            "MB received": megabytes, "RSS MB": rss, "peak RSS MB": peak}
+
+
+def report(results, service, pool):
+    columns = ["phase", "seconds", "requests", "requests/s", "tweets fetched",
+               "tweets stored", "tweets/s", "MB received", "RSS MB", "peak RSS MB"]
+    print()
+    print("  ".join(f"{column:>14}" for column in columns))
+    for result in results:
+        print("  ".join(f"{result[column]:>14.1f}" if isinstance(result[column], float)
+                        else f"{result[column]:>14}" for column in columns))
+    errors = service.stats()["errors"]
+    print(f"\nFake API errors served: {errors or 'none'}"
+          f"{' (429s mean the rate limiter let a request through over the limit)' if errors.get(429) else ''}")
+    for usage in pool.usage():
+        print(f"Credential set {usage['credential'] + 1}: {usage['calls']}, waited {usage['waited']}s for rate limits.")
+
+
+def main():
+
+    mongodb_config.configure(server_selection_timeout=2)
+    try:
+        client = mongodb_config.get_client()
+        client.admin.command("ping")
+    except pymongo.errors.PyMongoError:
+        print(f"MongoDB does not appear to be running here. You can start MongoDB with")
+        print(f"python3 epicosm.py --start_db")
+        sys.exit(0)
+    client.drop_database(args.database)
+    db = client[args.database]
+    collection = db.tweets
+    collection.create_index([("id_str", pymongo.ASCENDING)], unique=True)
+
+    service = fake_twitter.FakeTwitter(args.users, args.seed, args.latency, args.error_rate)
+    pool = rate_limit.CredentialPool([service.client() for credential in range(args.credentials)])
+    print(f"Benchmarking against a fake Twitter API: {args.users} users, {args.credentials} credential set(s), "
+          f"{args.workers} worker(s), {args.latency}s latency, {args.error_rate:.0%} errors.")
+
+    results = []
+    with tempfile.TemporaryDirectory() as run_folder:
+        with open(run_folder + "/user_list", "w") as user_list:
+            for index in range(args.users):
+                user_list.write(f"bench_user_{index}\n")
+        screen_names = [f"bench_user_{index}" for index in range(args.users)]
+
+        results.append(measure("lookup_users", service, collection, lambda: twitter_ops.lookup_users(
+            run_folder, screen_names, None, None, pool, args, db.screen_names)))
+
+        for cycle in range(args.cycles):
+            if cycle:
+                service.advance(args.days)
+            results.append(measure("harvest" if cycle == 0 else f"harvest +{args.days * cycle:g}d",
+                                   service, collection, lambda: twitter_ops.harvest(
+                run_folder, None, None, pool, client, db, collection, workers=args.workers,
+                batch_size=args.batch_size, raw_json=args.raw_json)))
+
+        if args.friends:
+            users = [fake_twitter.FIRST_USER_ID + index for index in range(min(args.friends, args.users))]
+            results.append(measure("get_friends", service, collection, lambda: twitter_ops.get_friends(
+                run_folder, None, None, pool, db.friends, db.friends_history,
+                full_cycle=True, users_to_follow=users)))
+
+    report(results, service, pool)
+    client.drop_database(args.database)
+
+
+if __name__ == "__main__":
+
+    parser, args = args_setup()
+    main()
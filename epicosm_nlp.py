@@ -1,9 +1,8 @@
 import sys
 import signal
 import argparse
-import subprocess
 
-from modules import mongo_ops, epicosm_meta, twitter_ops, nlp_ops, env_config, mongodb_config
+from modules import mongo_ops, epicosm_meta, twitter_ops, nlp_ops, env_config, mongodb_config, db_stats, backup_ops
 
 def args_setup():
 
@@ -30,10 +29,9 @@ def main():
     # Set paths as instance of EnvironmentConfig
     env = env_config.EnvironmentConfig()
 
-    try:
-        subprocess.check_output(["pgrep", "mongod"])
+    if mongo_ops.mongo_running():
         print(f"MongoDB looks up.")
-    except subprocess.CalledProcessError:
+    else:
         print(f"MongoDB does not appear to be running here. You can start MongoDB with")
         print(f"python3 epicosm.py --start_db")
         sys.exit(0)
@@ -57,6 +55,10 @@ def main():
         print(f"The database seems empty. Nothing to do.")
         sys.exit(0)
 
+    analyses = [analysis for analysis in ("vader", "labmt", "textblob", "liwc") if getattr(args, analysis)]
+    db_stats.set_process(mongodb_config.stats_collection, "nlp", "running", analyses=analyses)
+    db_stats.write_status(mongodb_config.stats_collection, env.status_file)
+
     if args.vader:
         nlp_ops.mongo_vader(mongodb_config.db, total_records)
 
@@ -69,11 +71,12 @@ def main():
     if args.liwc:
         nlp_ops.mongo_liwc(mongodb_config.db, total_records)
 
-    # backup database into BSON
-    mongo_ops.backup_db(mongodump_executable_path,
-                        env.database_dump_path,
-                        env.epicosm_log_filename,
-                        env.processtime)
+    db_stats.set_process(mongodb_config.stats_collection, "nlp", "idle", analyses=analyses)
+    db_stats.write_status(mongodb_config.stats_collection, env.status_file)
+
+    # backup the tweets the analyses have modified
+    backup_ops.backup(mongodb_config.db, env.backup_path)
+    backup_ops.rotate(env.backup_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,62 @@
+import sys
+import argparse
+
+from modules import backup_ops, env_config, mongo_ops, mongodb_config
+
+
+def args_setup():
+
+    parser = argparse.ArgumentParser(description="Epidemiology of Cohort Social Media - restore from backups",
+                                     epilog="Example: python3 epicosm_restore.py --database twitter_db_restored")
+    parser.add_argument("--backups", default=None,
+      help="Folder of backups to restore from (default ./output/backups).")
+    parser.add_argument("--database", default="twitter_db_restored",
+      help="Database to restore into (default twitter_db_restored). Collections in the backups replace those of the same name.")
+    parser.add_argument("--until", type=int, default=None,
+      help="Restore the database as it was at this backup number, rather than the latest.")
+    parser.add_argument("--list", action="store_true",
+      help="List the backups, and do nothing else.")
+    parser.add_argument("--verify", action="store_true",
+      help="Check every backup file against its checksum, and do nothing else.")
+
+    args = parser.parse_args()
+
+    return parser, args
+
+
+def main():
+
+    env = env_config.EnvironmentConfig()
+    backup_path = args.backups or env.backup_path
+    found = backup_ops.segments(backup_path)
+    if not found:
+        print(f"There are no backups in {backup_path}.")
+        sys.exit(0)
+
+    if args.list:
+        for segment in found:
+            tweets = segment["collections"].get("tweets", {}).get("documents", 0)
+            print(f"{segment['sequence']:>6}  {segment['kind']:<11}  up to {segment['until']}  {tweets:>10} tweets")
+        sys.exit(0)
+
+    if args.verify:
+        damaged = 0
+        for segment in found:
+            for file_name in backup_ops.verify(segment):
+                print(f"Backup {segment['sequence']}: {file_name} does not match its checksum.")
+                damaged += 1
+        print(f"{damaged or 'No'} damaged file(s) in {len(found)} backup(s).")
+        sys.exit(1 if damaged else 0)
+
+    if not mongo_ops.mongo_running():
+        print(f"MongoDB does not appear to be running here. You can start MongoDB with")
+        print(f"python3 epicosm.py --start_db")
+        sys.exit(0)
+
+    backup_ops.restore(mongodb_config.client[args.database], backup_path, args.until)
+
+
+if __name__ == "__main__":
+
+    parser, args = args_setup()
+    main()
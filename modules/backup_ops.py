@@ -0,0 +1,241 @@
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import shutil
+
+import bson
+import pymongo
+from bson.objectid import ObjectId
+
+from modules import db_migrations, network_ops
+
+
+FULL_EVERY = 7            # a full snapshot, then incrementals, every this many backups
+KEEP_FULL = 2             # full snapshots kept, each with the incrementals that follow it
+SETTLE_SECONDS = 60       # backups cover writes up to this long ago, so none still in flight are missed
+RESTORE_BATCH = 1000
+
+# Tweets are only ever inserted, or have fields added by NLP, which stamps
+# them with MODIFIED_FIELD (only when an analysis gives a tweet new values).
+MODIFIED_FIELD = "epicosm.modified"
+MODIFIED_STAMP = {MODIFIED_FIELD: True} # for "$currentDate" in updates of tweets
+
+# The collections an incremental backup holds only part of, with the fields
+# that show a document was inserted or changed since the previous backup:
+# its _id, an ObjectId made at insert, or a time stamped on every change.
+INCREMENTAL_FIELDS = {"tweets": ("_id", MODIFIED_FIELD),
+                      "friends": ("updated",),        # replaced by each new snapshot of a friend list
+                      "friends_history": ("_id",),    # only ever inserted
+                      "runs": ("_id",)}               # only ever inserted
+
+# made again from the friends collection when restoring, rather than backed up
+REBUILT_COLLECTIONS = ("friend_edges",)
+# results of --cofollow, which can be run again on the restored friend lists, and index build records
+SKIPPED_COLLECTIONS = ("cofollowed_accounts", "cofollow_similarity", "migrations")
+
+
+class HashingFile:
+
+    """A file that keeps the sha256 of everything written to it."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self.raw.write(data)
+
+    def flush(self):
+        self.raw.flush()
+
+
+def sha256_of(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as segment_file:
+        for block in iter(lambda: segment_file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def segments(backup_path):
+
+    """The manifests of the finished backups in backup_path, oldest first.
+    Each has its folder added as "path"."""
+
+    found = []
+    if not os.path.isdir(backup_path):
+        return found
+    for name in sorted(os.listdir(backup_path)):
+        manifest_file = os.path.join(backup_path, name, "manifest.json")
+        if os.path.isfile(manifest_file): # folders without one were never finished
+            with open(manifest_file) as manifest:
+                found.append(dict(json.load(manifest), path=os.path.join(backup_path, name)))
+    return sorted(found, key=lambda segment: segment["sequence"])
+
+
+def write_documents(path, documents):
+
+    """Write documents to path as gzipped BSON. Returns the count and the file's sha256."""
+
+    count = 0
+    with open(path, "wb") as raw:
+        hashing = HashingFile(raw)
+        with gzip.GzipFile(fileobj=hashing, mode="wb", compresslevel=6) as compressed:
+            for document in documents:
+                compressed.write(bson.BSON.encode(document))
+                count += 1
+    return count, hashing.sha256.hexdigest()
+
+
+def backup(db, backup_path, full=False):
+
+    """Back up db into a new segment folder in backup_path, and return its manifest.
+
+    The segment is a full snapshot if full is set, if there is none yet, or
+    if the last was FULL_EVERY backups ago; otherwise the collections in
+    INCREMENTAL_FIELDS hold only the documents inserted or modified since the
+    previous backup. The rest, whose documents change in place without a
+    stamp (counters, cursors, screen names), hold a few documents per user and
+    are copied whole every time. Each collection is a
+    gzipped BSON file, listed in the segment's manifest.json with its
+    document count and sha256; the manifest is written last, so a backup cut
+    short is never mistaken for a finished one."""
+
+    previous = segments(backup_path)
+    fulls = [segment for segment in previous if segment["kind"] == "full"]
+    if not full and fulls and len(previous) - previous.index(fulls[-1]) < FULL_EVERY:
+        kind, since = "incremental", datetime.datetime.fromisoformat(previous[-1]["until"])
+    else:
+        kind, since = "full", None
+    until = datetime.datetime.utcnow() - datetime.timedelta(seconds=SETTLE_SECONDS)
+    sequence = previous[-1]["sequence"] + 1 if previous else 1
+
+    print(f"Backing up the database ({kind})...")
+    started = datetime.datetime.utcnow()
+    name = f"{sequence:06d}_{kind}_{started.strftime('%Y-%m-%d_%H-%M-%S')}"
+    partial_path = os.path.join(backup_path, name + ".partial")
+    os.makedirs(partial_path, exist_ok=True)
+
+    collections = {}
+    for collection_name in sorted(db.list_collection_names()):
+        if (collection_name.startswith("system.") or collection_name in SKIPPED_COLLECTIONS
+                or collection_name in REBUILT_COLLECTIONS):
+            continue
+        incremental = kind == "incremental" and collection_name in INCREMENTAL_FIELDS
+        if incremental:
+            query = {"$or": [{"_id": {"$gte": ObjectId.from_datetime(since), "$lt": ObjectId.from_datetime(until)}}
+                             if field == "_id" else {field: {"$gte": since, "$lt": until}}
+                             for field in INCREMENTAL_FIELDS[collection_name]]}
+        else:
+            query = {}
+        file_name = collection_name + ".bson.gz"
+        count, sha256 = write_documents(os.path.join(partial_path, file_name),
+                                        db[collection_name].find(query, sort=[("_id", pymongo.ASCENDING)]))
+        collections[collection_name] = {"file": file_name, "mode": "incremental" if incremental else "full",
+                                        "documents": count, "sha256": sha256}
+
+    manifest = {"sequence": sequence, "kind": kind, "database": db.name,
+                "since": since.isoformat() if since else None, "until": until.isoformat(),
+                "started": started.isoformat(), "collections": collections,
+                "rebuild": [collection_name for collection_name in REBUILT_COLLECTIONS
+                            if db[collection_name].estimated_document_count()]}
+    with open(os.path.join(partial_path, "manifest.json"), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    final_path = os.path.join(backup_path, name)
+    os.rename(partial_path, final_path)
+
+    size = sum(os.path.getsize(os.path.join(final_path, entry["file"])) for entry in collections.values())
+    print(f"OK, backup {sequence} ({kind}) written to {final_path}: "
+          f"{collections.get('tweets', {}).get('documents', 0)} tweets, {size / 1e6:.1f}MB, "
+          f"in {(datetime.datetime.utcnow() - started).total_seconds():.0f}s.")
+    return dict(manifest, path=final_path)
+
+
+def rotate(backup_path, keep_full=KEEP_FULL):
+
+    """Remove the backups older than the keep_full most recent full snapshots,
+    and any left unfinished."""
+
+    finished = segments(backup_path)
+    fulls = [segment for segment in finished if segment["kind"] == "full"]
+    oldest_kept = fulls[-keep_full]["sequence"] if len(fulls) >= keep_full else 0
+    for segment in finished:
+        if segment["sequence"] < oldest_kept:
+            print(f"Removing old backup {os.path.basename(segment['path'])}.")
+            shutil.rmtree(segment["path"])
+    for name in os.listdir(backup_path) if os.path.isdir(backup_path) else []:
+        if name.endswith(".partial"):
+            shutil.rmtree(os.path.join(backup_path, name))
+
+
+def verify(segment):
+
+    """The files of a segment whose sha256 does not match its manifest."""
+
+    return [entry["file"] for entry in segment["collections"].values()
+            if not os.path.isfile(os.path.join(segment["path"], entry["file"]))
+            or sha256_of(os.path.join(segment["path"], entry["file"])) != entry["sha256"]]
+
+
+def restore_chain(backup_path, until=None):
+
+    """The segments to replay to restore backup until (a sequence number; the
+    latest by default): the last full snapshot at or before it, then every
+    incremental after that, in order."""
+
+    chain = [segment for segment in segments(backup_path) if until is None or segment["sequence"] <= until]
+    fulls = [index for index, segment in enumerate(chain) if segment["kind"] == "full"]
+    if not fulls:
+        return []
+    return chain[fulls[-1]:]
+
+
+def restore(db, backup_path, until=None):
+
+    """Restore db from the backups in backup_path, replaying segments in order.
+
+    Every file is checked against its sha256 before anything is written.
+    A collection copied whole replaces what db holds of it; the documents of
+    an incremental one are upserted by _id over the snapshot. The friend edge list, if
+    the database had one, is made again from the friend lists, and the indexes
+    declared in db_migrations are built. Returns the segments replayed."""
+
+    chain = restore_chain(backup_path, until)
+    if not chain:
+        print(f"No full backup found in {backup_path} to restore from.")
+        return []
+    damaged = {os.path.basename(segment["path"]): verify(segment) for segment in chain}
+    damaged = {name: files for name, files in damaged.items() if files}
+    if damaged:
+        print(f"Not restoring: these backup files do not match their checksums: {damaged}")
+        return []
+
+    for segment in chain:
+        print(f"Restoring backup {segment['sequence']} ({segment['kind']}, up to {segment['until']})...")
+        for collection_name, entry in segment["collections"].items():
+            collection = db[collection_name]
+            if entry["mode"] == "full":
+                collection.drop()
+            batch = []
+            with gzip.open(os.path.join(segment["path"], entry["file"]), "rb") as compressed:
+                for document in bson.decode_file_iter(compressed):
+                    if entry["mode"] == "full":
+                        batch.append(pymongo.InsertOne(document))
+                    else:
+                        batch.append(pymongo.ReplaceOne({"_id": document["_id"]}, document, upsert=True))
+                    if len(batch) == RESTORE_BATCH:
+                        collection.bulk_write(batch, ordered=False)
+                        batch = []
+            if batch:
+                collection.bulk_write(batch, ordered=False)
+            print(f"  {collection_name}: {entry['documents']} documents.")
+    if "friend_edges" in chain[-1].get("rebuild", []):
+        print(f"Rebuilding the friend edge list from the friend lists...")
+        edges = network_ops.rebuild_friend_edges(db.friends, db.friend_edges)
+        print(f"  friend_edges: {edges} documents.")
+    db_migrations.migrate(db, wait=True)
+    print(f"OK, {db.name} restored to backup {chain[-1]['sequence']}.")
+    return chain
@@ -0,0 +1,117 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import pymongo
+
+
+FLUSH_SECONDS = 0.05   # how long a write may wait for others to share its round trip
+
+
+class BulkWriter(threading.Thread):
+
+    """A thread that makes MongoDB writes on behalf of several pipelines.
+
+    Writes submitted from any thread are queued, and whatever has arrived for
+    a collection within FLUSH_SECONDS (up to batch_size operations) goes to
+    MongoDB as one unordered bulk_write. Each submission gets a Future of
+    (succeeded, duplicates, positions of the duplicates), so a caller that needs its write to be stored
+    before going on (a timeline page, before the cursor moves) can wait for
+    it, while others carry on without waiting. Duplicate key errors count as
+    duplicates; any other error is printed and raised from the Future."""
+
+    def __init__(self, batch_size=1000, flush_seconds=FLUSH_SECONDS):
+        super().__init__(daemon=True)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.queue = queue.Queue()
+        self.round_trips = 0
+
+    def submit(self, collection, operations):
+        future = Future()
+        if not operations:
+            future.set_result((0, 0, []))
+            return future
+        self.queue.put((collection, list(operations), future))
+        return future
+
+    def close(self):
+
+        """Write everything still queued, then stop the thread."""
+
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        closing = False
+        while not closing:
+            item = self.queue.get()
+            if item is None:
+                break
+            pending = [item]
+            count = len(item[1])
+            deadline = time.time() + self.flush_seconds
+            while count < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                pending.append(item)
+                count += len(item[1])
+            self.flush(pending)
+
+    def flush(self, pending):
+
+        """One bulk_write per collection (and write concern) for the queued submissions."""
+
+        groups = {}
+        for collection, operations, future in pending:
+            key = (collection.full_name, repr(collection.write_concern))
+            groups.setdefault(key, (collection, []))[1].append((operations, future))
+
+        for collection, submissions in groups.values():
+            operations = [operation for submitted, future in submissions for operation in submitted]
+            errors = []
+            failure = None
+            try:
+                collection.bulk_write(operations, ordered=False)
+            except pymongo.errors.BulkWriteError as e:
+                errors = e.details["writeErrors"]
+            except Exception as e:
+                failure = e
+            self.round_trips += 1
+
+            # hand each submission the errors that fall within its operations
+            start = 0
+            for submitted, future in submissions:
+                end = start + len(submitted)
+                if failure is not None:
+                    print(f"Problem writing to {collection.full_name}: {failure}")
+                    future.set_exception(failure)
+                    start = end
+                    continue
+                own = [error for error in errors if start <= error["index"] < end]
+                duplicates = sum(1 for error in own if error["code"] == 11000)
+                if duplicates < len(own):
+                    error = pymongo.errors.BulkWriteError({"writeErrors": own, "nInserted": 0})
+                    print(f"Problem writing to {collection.full_name}: {own[0].get('errmsg')}")
+                    future.set_exception(error)
+                else:
+                    future.set_result((len(submitted) - duplicates, duplicates,
+                                       [error["index"] - start for error in own]))
+                start = end
+
+
+def write(collection, operations, writer=None):
+
+    """Write operations to collection, through writer if there is one.
+    Without a writer the write is made here and now, as one unordered bulk_write."""
+
+    if writer is not None:
+        return writer.submit(collection, operations)
+    if operations:
+        collection.bulk_write(operations, ordered=False)
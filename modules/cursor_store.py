@@ -0,0 +1,77 @@
+import datetime
+
+import pymongo
+
+
+def get_cursor(cursor_collection, collection, twitter_id):
+
+    """Return the harvest cursor of a user, or None if they have never been harvested.
+
+    Users harvested before cursors existed have tweets but no cursor document,
+    so their cursor is rebuilt once from the newest and oldest stored tweets."""
+
+    cursor = cursor_collection.find_one({"_id": twitter_id})
+    if cursor is not None:
+        return cursor
+
+    newest = collection.find_one({"user.id": twitter_id}, {"id": 1},
+                                 sort=[("id", pymongo.DESCENDING)])
+    if newest is None:
+        return None
+    oldest = collection.find_one({"user.id": twitter_id}, {"id": 1},
+                                 sort=[("id", pymongo.ASCENDING)])
+    cursor = {"_id": twitter_id,
+              "newest_id": newest["id"],
+              "oldest_id": oldest["id"],
+              "last_harvest": None,
+              "status": "ok"}
+    cursor_collection.replace_one({"_id": twitter_id}, cursor, upsert=True)
+    return cursor
+
+
+def update_cursor(cursor_collection, twitter_id, newest_id, oldest_id, status,
+                  statuses_count=None, rate=None):
+
+    """Record the outcome of a harvest of one user.
+
+    newest_id only moves forward and oldest_id only moves back, and neither is
+    touched unless the harvest finished ("ok"), so an interrupted catch-up is
+    asked for again in full next cycle rather than leaving a gap.
+    statuses_count is the profile tweet count seen before the harvest; it is
+    what the next cycle compares against to decide if the user has posted.
+    rate is the user's estimated posting rate, in tweets per day."""
+
+    update = {"$set": {"last_harvest": datetime.datetime.utcnow(),
+                       "status": status}}
+    if statuses_count is not None and status in ("ok", "empty"):
+        update["$set"]["statuses_count"] = statuses_count
+    if rate is not None:
+        update["$set"]["rate"] = rate
+    if status == "ok" and newest_id is not None:
+        update["$max"] = {"newest_id": newest_id}
+        if oldest_id is not None:
+            update["$min"] = {"oldest_id": oldest_id}
+    cursor_collection.update_one({"_id": twitter_id}, update, upsert=True)
+
+
+def mark_checked(cursor_collection, twitter_ids, rate_decay):
+
+    """Record that users were looked at but had nothing new to harvest.
+
+    Their last_harvest moves on, and their posting rate is scaled by rate_decay
+    as if a harvest had found no tweets, so quiet users drift to longer poll
+    intervals. Users with no cursor yet (e.g. private accounts, which are
+    never harvested) are given one with status "checked", so they too wait a
+    poll interval before they are looked at again."""
+
+    twitter_ids = list(twitter_ids)
+    if not twitter_ids:
+        return
+    now = datetime.datetime.utcnow()
+    cursor_collection.bulk_write([pymongo.UpdateOne({"_id": twitter_id},
+                                                    {"$set": {"last_harvest": now},
+                                                     "$setOnInsert": {"status": "checked"}},
+                                                    upsert=True)
+                                  for twitter_id in twitter_ids], ordered=False)
+    cursor_collection.update_many({"_id": {"$in": twitter_ids}, "rate": {"$exists": True}},
+                                  {"$mul": {"rate": rate_decay}})
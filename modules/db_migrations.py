@@ -0,0 +1,157 @@
+import datetime
+import sys
+import threading
+import time
+
+import pymongo
+
+
+# The indexes the harvest, NLP and analysis queries rely on, by collection,
+# as (keys, options, needed before harvesting). Indexes needed before
+# harvesting are built before anything is written; the rest are built in the
+# background while the harvest runs, because on a large collection they take
+# a long time and only make queries faster.
+INDEXES = {
+    "tweets": [
+        # duplicate tweets are rejected by this, so it must exist before any insert
+        ([("id_str", pymongo.ASCENDING)], {"unique": True}, True),
+        # a user's tweets, newest first: harvest cursors, posting rates, per-user counts.
+        # Queries on user.id alone use it too, so there is no separate user.id index.
+        ([("user.id", pymongo.ASCENDING), ("id", pymongo.DESCENDING)], {}, False),
+        # groundtruth and NLP, which go by the string form of the user id
+        ([("user.id_str", pymongo.ASCENDING)], {}, False),
+        # tweets modified by NLP since the last incremental backup (see backup_ops)
+        ([("epicosm.modified", pymongo.ASCENDING)], {"sparse": True}, False),
+    ],
+    "screen_names": [
+        ([("id", pymongo.ASCENDING)], {}, False),
+    ],
+    "friends": [
+        ([("user_id", pymongo.ASCENDING)], {}, False),
+    ],
+    "friends_history": [
+        ([("user_id", pymongo.ASCENDING), ("time", pymongo.DESCENDING)], {}, False),
+    ],
+    "runs": [
+        ([("recorded", pymongo.DESCENDING)], {}, False),
+    ],
+    "stats": [
+        # the status reads counters by kind: users, runs by start
+        ([("kind", pymongo.ASCENDING), ("started", pymongo.DESCENDING)], {}, False),
+    ],
+}
+
+
+def index_name(keys):
+
+    """The name MongoDB gives an index on keys, e.g. user.id_1_id_-1."""
+
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+
+def missing_indexes(db):
+
+    """The declared indexes that db does not have yet, as (collection name, keys, options, needed)."""
+
+    missing = []
+    for collection_name, indexes in INDEXES.items():
+        existing = db[collection_name].index_information()
+        for keys, options, needed in indexes:
+            if index_name(keys) not in existing:
+                missing.append((collection_name, keys, options, needed))
+    return missing
+
+
+def build(db, indexes):
+
+    """Build indexes, recording each in db.migrations. One that fails (e.g. a
+    unique index over a collection that already holds duplicates) is reported;
+    if the harvest needs it, Epicosm exits saying how to put it right,
+    otherwise it is skipped and the others are still built."""
+
+    for collection_name, keys, options, needed in indexes:
+        name = index_name(keys)
+        started = time.time()
+        try:
+            # background only matters before MongoDB 4.2, which builds indexes without blocking anyway
+            db[collection_name].create_index(keys, name=name, background=True, **options)
+        except pymongo.errors.OperationFailure as e:
+            print(f"Could not build index {name} on {collection_name}: {e}")
+            if not needed:
+                continue
+            print(f"Epicosm cannot run without this index.")
+            if options.get("unique"):
+                field = keys[0][0]
+                print(f"{collection_name} holds documents with the same {field}; keep one of each and remove "
+                      f"the rest, e.g. in the mongo shell:\n"
+                      f"  use {db.name}\n"
+                      f"  db.{collection_name}.aggregate([{{$group: {{_id: \"${field}\", ids: {{$push: \"$_id\"}}, "
+                      f"count: {{$sum: 1}}}}}}, {{$match: {{count: {{$gt: 1}}}}}}], {{allowDiskUse: true}})"
+                      f".forEach(function(duplicate) {{ duplicate.ids.shift(); "
+                      f"db.{collection_name}.deleteMany({{_id: {{$in: duplicate.ids}}}}); }})\n"
+                      f"then start Epicosm again.")
+            sys.exit(1)
+        seconds = round(time.time() - started, 1)
+        db.migrations.replace_one({"_id": f"{collection_name}.{name}"},
+                                  {"collection": collection_name, "index": name,
+                                   "built": datetime.datetime.utcnow(), "seconds": seconds},
+                                  upsert=True)
+        print(f"Index {name} on {collection_name} built in {seconds}s.")
+
+
+def migrate(db, wait=False):
+
+    """Bring db up to the declared indexes.
+
+    Missing indexes the harvest needs are built straight away; the others are
+    built in a background thread, which is returned (or None if there was
+    nothing to build there), unless wait is set."""
+
+    missing = missing_indexes(db)
+    if not missing:
+        return None
+    now = [index for index in missing if index[3] or wait]
+    later = [index for index in missing if not (index[3] or wait)]
+    print(f"Building {len(missing)} missing MongoDB index(es)"
+          f"{f', {len(later)} in the background' if later else ''}...")
+    build(db, now)
+    if not later:
+        return None
+    builder = threading.Thread(target=build, args=(db, later), name="index-builder", daemon=True)
+    builder.start()
+    return builder
+
+
+def index_usage(db):
+
+    """How often each index of the declared collections has been used since
+    mongod started, from $indexStats, as a list of dicts of collection, index,
+    ops, since and declared."""
+
+    usage = []
+    for collection_name, indexes in INDEXES.items():
+        declared = {index_name(keys) for keys, options, needed in indexes} | {"_id_"}
+        try:
+            stats = list(db[collection_name].aggregate([{"$indexStats": {}}]))
+        except pymongo.errors.OperationFailure: # collection not created yet
+            continue
+        for index in stats:
+            usage.append({"collection": collection_name, "index": index["name"],
+                          "ops": index["accesses"]["ops"], "since": index["accesses"]["since"],
+                          "declared": index["name"] in declared})
+    return usage
+
+
+def print_index_usage(db):
+
+    """Print how much each index has been used, and which declared ones are missing."""
+
+    usage = index_usage(db)
+    if not usage:
+        return
+    print(f"MongoDB index use since {min(index['since'] for index in usage):%Y-%m-%d %H:%M}:")
+    for index in sorted(usage, key=lambda index: (index["collection"], -index["ops"])):
+        print(f"  {index['collection'] + '.' + index['index']:<40} {index['ops']:>12} ops"
+              f"{'' if index['declared'] else '  (not declared in db_migrations)'}")
+    for collection_name, keys, options, needed in missing_indexes(db):
+        print(f"  {collection_name + '.' + index_name(keys):<40}      missing (still building, or failed)")
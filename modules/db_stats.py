@@ -0,0 +1,231 @@
+import collections
+import datetime
+import json
+
+import pymongo
+
+from modules import bulk_writer
+
+
+# Counters of what the database holds, one document each in the stats collection:
+#   totals          tweets stored, and when the last were
+#   user.<id>       tweets stored of one user, with the newest and oldest tweet id
+#   day.<date>      tweets stored that were posted on that (UTC) day
+#   run.<start>     what a harvest run inserted
+#   nlp.<analysis>  tweets an NLP analysis has been applied to
+#   geo             tweets stored by the geoharvester
+#   process.<name>  whether harvest, nlp or geo is running, and since when
+# They are kept up to date as tweets are written, so the status can be read
+# from a few small documents rather than by counting the tweets collection.
+
+STATS_COLLECTION = "stats"
+
+MONTHS = {month: number for number, month in
+          enumerate(("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"), 1)}
+
+RECENT_DAYS = 7
+
+
+def tweet_day(created_at):
+
+    """The UTC day of a tweet's created_at (e.g. "Wed Oct 10 20:19:24 +0000 2018") as YYYY-MM-DD."""
+
+    try:
+        return f"{created_at[-4:]}-{MONTHS[created_at[4:7]]:02d}-{int(created_at[8:10]):02d}"
+    except (TypeError, KeyError, ValueError):
+        return "unknown"
+
+
+def tweet_updates(documents, now=None):
+
+    """The counter updates for newly stored tweets: totals, each of their users and each day."""
+
+    now = now or datetime.datetime.utcnow()
+    users = collections.Counter()
+    newest = {}
+    oldest = {}
+    days = collections.Counter()
+    for document in documents:
+        user_id = document.get("user", {}).get("id")
+        users[user_id] += 1
+        newest[user_id] = max(newest.get(user_id, 0), document.get("id", 0))
+        oldest[user_id] = min(oldest.get(user_id, document.get("id", 0)), document.get("id", 0))
+        days[tweet_day(document.get("created_at"))] += 1
+    if not users:
+        return []
+
+    updates = [pymongo.UpdateOne({"_id": "totals"},
+                                 {"$inc": {"tweets": sum(users.values())}, "$set": {"kind": "totals", "updated": now}},
+                                 upsert=True)]
+    for user_id, count in users.items():
+        updates.append(pymongo.UpdateOne({"_id": f"user.{user_id}"},
+                                         {"$inc": {"tweets": count},
+                                          "$max": {"newest_id": newest[user_id]},
+                                          "$min": {"oldest_id": oldest[user_id]},
+                                          "$set": {"kind": "user", "user_id": user_id, "updated": now}},
+                                         upsert=True))
+    for day, count in days.items():
+        updates.append(pymongo.UpdateOne({"_id": f"day.{day}"},
+                                         {"$inc": {"tweets": count}, "$set": {"kind": "day", "day": day}},
+                                         upsert=True))
+    return updates
+
+
+def count_tweets(stats_collection, documents, writer=None):
+
+    """Add newly stored tweets to the counters, through writer (a BulkWriter) if there is one."""
+
+    bulk_writer.write(stats_collection, tweet_updates(documents), writer)
+
+
+def record_run(stats_collection, started, **counts):
+
+    """Store what a harvest run did, keyed on when it started."""
+
+    stats_collection.replace_one({"_id": f"run.{started.isoformat()}"},
+                                 dict(counts, kind="run", started=started, finished=datetime.datetime.utcnow()),
+                                 upsert=True)
+
+
+def record_nlp(stats_collection, analysis, analysed):
+
+    """Record that an NLP analysis has been applied to analysed tweets."""
+
+    stats_collection.update_one({"_id": f"nlp.{analysis}"},
+                                {"$set": {"kind": "nlp", "analysis": analysis, "analysed": analysed,
+                                          "updated": datetime.datetime.utcnow()}},
+                                upsert=True)
+
+
+def count_geotweet(stats_collection, created_at=None):
+
+    """Add one tweet stored by the geoharvester."""
+
+    stats_collection.update_one({"_id": "geo"},
+                                {"$inc": {"tweets": 1},
+                                 "$set": {"kind": "geo", "updated": datetime.datetime.utcnow(), "latest": created_at}},
+                                upsert=True)
+
+
+def set_process(stats_collection, process, state, **details):
+
+    """Record that process (harvest, nlp or geo) is now "running" or "idle"."""
+
+    stats_collection.replace_one({"_id": f"process.{process}"},
+                                 dict(details, kind="process", process=process, state=state,
+                                      since=datetime.datetime.utcnow()),
+                                 upsert=True)
+
+
+def rebuild(stats_collection, collection):
+
+    """Work the tweet counters out from scratch, from every stored tweet.
+
+    This is a scan of the whole collection, for databases harvested before
+    there were counters; from then on they are kept up to date as tweets are
+    stored."""
+
+    print(f"Counting the tweets already stored, once, for the status counters...")
+    now = datetime.datetime.utcnow()
+    stats_collection.delete_many({"kind": {"$in": ["totals", "user", "day"]}})
+    updates = []
+    days = collections.Counter()
+    total = 0
+    for user in collection.aggregate([{"$group": {"_id": "$user.id", "tweets": {"$sum": 1},
+                                                  "newest_id": {"$max": "$id"}, "oldest_id": {"$min": "$id"}}}],
+                                     allowDiskUse=True):
+        total += user["tweets"]
+        updates.append(pymongo.InsertOne({"_id": f"user.{user['_id']}", "kind": "user", "user_id": user["_id"],
+                                          "tweets": user["tweets"], "newest_id": user["newest_id"],
+                                          "oldest_id": user["oldest_id"], "updated": now}))
+    # grouped on the weekday, month and day, and the year, of created_at, e.g. "Wed Oct 10 2018"
+    created = {"$ifNull": ["$created_at", ""]}
+    for day in collection.aggregate([{"$group": {"_id": {"$concat": [{"$substrBytes": [created, 0, 11]},
+                                                                     {"$substrBytes": [created, 26, 4]}]},
+                                                 "tweets": {"$sum": 1}}}], allowDiskUse=True):
+        days[tweet_day(day["_id"])] += day["tweets"]
+    for day, count in days.items():
+        updates.append(pymongo.InsertOne({"_id": f"day.{day}", "kind": "day", "day": day, "tweets": count}))
+    updates.append(pymongo.InsertOne({"_id": "totals", "kind": "totals", "tweets": total, "updated": now}))
+    stats_collection.bulk_write(updates, ordered=False)
+    print(f"OK, {total} tweets from {len(updates) - len(days) - 1} users counted.")
+
+
+def ensure_counters(stats_collection, collection):
+
+    """Build the tweet counters if the database has tweets but no counters yet."""
+
+    if stats_collection.find_one({"_id": "totals"}, {"_id": 1}) is None and collection.estimated_document_count():
+        rebuild(stats_collection, collection)
+
+
+def status(stats_collection):
+
+    """The state of every process and the counters, as a dict ready for JSON.
+
+    Only the small counter documents are read: totals, the user count, the
+    last RECENT_DAYS days, the latest run, NLP coverage and the geoharvester."""
+
+    documents = {document["_id"]: document for document in
+                 stats_collection.find({"kind": {"$in": ["totals", "process", "nlp", "geo"]}})}
+    totals = documents.get("totals", {})
+    tweets = totals.get("tweets", 0)
+    today = datetime.datetime.utcnow().date()
+    recent_days = [str(today - datetime.timedelta(days=days_ago)) for days_ago in range(RECENT_DAYS)]
+    recent = {day["day"]: day["tweets"] for day in
+              stats_collection.find({"_id": {"$in": [f"day.{day}" for day in recent_days]}})}
+    last_run = stats_collection.find_one({"kind": "run"}, sort=[("started", pymongo.DESCENDING)])
+
+    def clean(document):
+        return {key: value for key, value in (document or {}).items() if key not in ("_id", "kind")} or None
+
+    return {"processes": {document["process"]: clean(document)
+                          for document in documents.values() if document["kind"] == "process"},
+            "tweets": tweets,
+            "users": stats_collection.count_documents({"kind": "user"}),
+            "last_stored": totals.get("updated"),
+            "tweets_by_day": {day: recent.get(day, 0) for day in recent_days},
+            "last_run": clean(last_run),
+            "nlp": {document["analysis"]: dict(clean(document),
+                                               coverage=round(document["analysed"] / tweets, 3) if tweets else None)
+                    for document in documents.values() if document["kind"] == "nlp"},
+            "geo": clean(documents.get("geo"))}
+
+
+def write_status(stats_collection, status_file):
+
+    """Write the STATUS file, and STATUS.json beside it, from the counters."""
+
+    current = status(stats_collection)
+    harvest = current["processes"].get("harvest") or {}
+    lines = []
+    if harvest.get("state") == "running":
+        lines.append(f"Epicosm is currently running.")
+        lines.append(f"This process started at {harvest['since'].strftime('%Y-%m-%d_%H:%M:%S')} UTC")
+    else:
+        lines.append(f"Epicosm is currently idle.")
+        if harvest.get("since"):
+            lines.append(f"The most recent harvest was at {harvest['since'].strftime('%Y-%m-%d_%H:%M:%S')} UTC")
+    lines.append(f"The database currently contains {current['tweets']} tweets from {current['users']} users.")
+    lines.append(f"Tweets posted in the last {RECENT_DAYS} days: " +
+                 ", ".join(f"{day} {count}" for day, count in current["tweets_by_day"].items()))
+    if current["last_run"]:
+        run = current["last_run"]
+        lines.append(f"The last harvest inserted {run.get('inserted', 0)} tweets "
+                     f"({run.get('duplicates', 0)} duplicates) from {run.get('users', 0)} users.")
+    for analysis, nlp in sorted(current["nlp"].items()):
+        coverage = f" ({nlp['coverage']:.0%} of the database)" if nlp["coverage"] is not None else ""
+        lines.append(f"NLP {analysis}: {nlp['analysed']} tweets analysed{coverage}, "
+                     f"at {nlp['updated'].strftime('%Y-%m-%d_%H:%M:%S')} UTC")
+    for process in ("nlp", "geo"):
+        state = current["processes"].get(process)
+        if state and state["state"] == "running":
+            lines.append(f"{'NLP' if process == 'nlp' else 'The geoharvester'} is running, "
+                         f"since {state['since'].strftime('%Y-%m-%d_%H:%M:%S')} UTC.")
+    if current["geo"]:
+        lines.append(f"The geoharvester has stored {current['geo']['tweets']} tweets.")
+    with open(status_file, "w+") as status_text:
+        status_text.write("\n".join(lines) + "\n")
+    with open(status_file + ".json", "w+") as status_json:
+        json.dump(current, status_json, indent=2, default=str)
+    return current
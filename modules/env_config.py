@@ -51,6 +51,10 @@ class EnvironmentConfig:
     def csv_friends_filename(self):
         return os.path.join(self.run_folder, 'output', 'csv', "friends" + self.processtime + ".csv")
 
+    @property
+    def network_filename(self):
+        return os.path.join(self.run_folder, 'output', 'network', "friends" + self.processtime)
+
     @property
     def epicosm_log_filename(self):
         return os.path.join(self.run_folder, 'epicosm_logs', self.processtime + ".log")
@@ -63,3 +67,7 @@ class EnvironmentConfig:
     def database_dump_path(self):
         return os.path.join(self.run_folder, 'output')
 
+    @property
+    def backup_path(self):
+        return os.path.join(self.run_folder, 'output', 'backups')
+
@@ -1,18 +1,13 @@
-import datetime
 import os
-import pymongo
 import sys
 import logging
 import subprocess
 
 # local imports
-from modules import env_config, mongo_ops
+from modules import db_stats, env_config, mongo_ops, mongodb_config
 
 
 env = env_config.EnvironmentConfig()
-client = pymongo.MongoClient('localhost', 27017)
-db = client.twitter_db
-collection = db.tweets
 
 
 # Catch ctrl-c signals (and kill -15 signals)
@@ -84,30 +79,34 @@ def logger_setup(epicosm_log_filename):
 
 
 def status_up(status_file):
-    
+
     """ Update STATUS file in run folder to notify when running.
-    
-    Does a quick count of the current database,
-    and rewrite the STATUS file to say that process is in progress."""
-    
-    tweet_count = collection.count_documents({})
-    with open(status_file, 'w+') as status:
-        status.write(f"Epicosm is currently running.\nThis process started at {datetime.datetime.now().strftime('%Y-%m-%d_%H:%M:%S')}\n")
-        if tweet_count > 0:
-            status.write(f"The database currently contains {tweet_count} tweets.\n")
+
+    The STATUS file, and STATUS.json beside it, are written from the counters
+    in the stats collection (see db_stats), so no tweets are counted here;
+    a database with tweets but no counters yet has them built once."""
+
+    db_stats.ensure_counters(mongodb_config.stats_collection, mongodb_config.collection)
+    db_stats.set_process(mongodb_config.stats_collection, "harvest", "running")
+    db_stats.write_status(mongodb_config.stats_collection, status_file)
 
 
 def status_down(status_file, run_folder):
 
     """ Update STATUS file in run folder to notify when idle, and next run.
-                     
-    Does a quick count of the current database,
-    and rewrite the STATUS file to say that process is in progress."""
 
-    tweet_count = collection.count_documents({})
-    with open(status_file, 'w+') as status:
-        next_harvest = (datetime.datetime.now() + datetime.timedelta(hours = 72)).strftime('%Y-%m-%d_' + "06:00:00")
-        status.write(f"Epicosm is currently idle.\nThe most recent harvest was at {datetime.datetime.now().strftime('%Y-%m-%d_%H:%M:%S')}\nThe database currently contains {tweet_count} tweets.\n")
+    As status_up, from the counters in the stats collection."""
+
+    db_stats.set_process(mongodb_config.stats_collection, "harvest", "idle")
+    db_stats.write_status(mongodb_config.stats_collection, status_file)
+
+
+def read_screen_names(run_folder):
+
+    """The screen names in user_list, once each and without blank lines."""
+
+    screen_names = list(dict.fromkeys(line.strip() for line in open(run_folder + '/user_list'))) # remove duplicates
+    return [name for name in screen_names if name] # remove empty lines
 
 
 def check_env():
@@ -151,9 +150,7 @@ def check_env():
         print("Your credentials.txt file doesn't seem to exist here.")
         sys.exit()
 
-    number_of_users_provided = sum(1 for line_exists in open(env.run_folder + '/user_list') if line_exists)
-    screen_names = list(dict.fromkeys(line.strip() for line in open(env.run_folder + '/user_list'))) # remove duplicates
-    screen_names = [name for name in screen_names if name] # remove empty lines
+    screen_names = read_screen_names(env.run_folder)
 
     # Check or make directory structure
     if not os.path.exists(env.run_folder + '/db'):
@@ -0,0 +1,357 @@
+import collections
+import datetime
+import json
+import math
+import random
+import threading
+import time
+
+import numpy as np
+import tweepy
+
+from modules import poll_scheduler, rate_limit
+
+
+FIRST_USER_ID = 10_000_000        # ids of the synthetic cohort count up from here
+FIRST_ACCOUNT_ID = 500_000_000    # and ids of the accounts they follow from here
+POPULAR_ACCOUNTS = 200_000        # size of the pool of accounts that users follow
+HISTORY_DAYS = 730                # how far back synthetic timelines go
+FUTURE_DAYS = 60                  # and how far forward, for tweets that appear as the clock advances
+MAX_TWEETS = 4000                 # tweets generated per user; only the newest 3200 are ever served
+TIMELINE_DEPTH = 3200             # as on Twitter, older tweets cannot be paged to
+WORDS = ("the", "a", "today", "really", "think", "new", "good", "people", "time", "home", "love",
+         "work", "just", "great", "week", "night", "happy", "feel", "still", "never", "got", "day")
+
+
+class FakeResponse:
+
+    """Enough of a requests.Response for the error handling in twitter_ops."""
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def twitter_time(tweet_id):
+    return poll_scheduler.tweet_time(tweet_id).strftime("%a %b %d %H:%M:%S +0000 %Y")
+
+
+class FakeTwitter:
+
+    """An offline stand-in for the Twitter API, serving a synthetic cohort.
+
+    User i (0 <= i < users) has id FIRST_USER_ID + i and screen name
+    bench_user_i. Each user's posting rate, timeline and friend list are drawn
+    from a random generator seeded by the user, so the same cohort is served
+    every run. A small share of users are private or have never tweeted.
+
+    Timelines are generated HISTORY_DAYS back and FUTURE_DAYS forward from the
+    start, and only tweets up to the service clock are visible; advance() moves
+    the clock on, so the next harvest finds new tweets as it would in a real
+    cycle. Clients (see client()) add latency, errors and rate limits, and
+    the service counts the requests, tweets and bytes it has served."""
+
+    def __init__(self, users=100, seed=0, latency=0.0, error_rate=0.0,
+                 private_share=0.02, empty_share=0.02,
+                 limits=rate_limit.ENDPOINT_LIMITS, window=rate_limit.WINDOW_SECONDS):
+        self.users = users
+        self.seed = seed
+        self.latency = latency
+        self.error_rate = error_rate
+        self.private_share = private_share
+        self.empty_share = empty_share
+        self.limits = dict(limits)
+        self.window = window
+        self.start = datetime.datetime.utcnow()
+        self.clock = self.start
+        self.profiles = {}
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.errors = collections.Counter()
+        self.tweets_served = 0
+        self.bytes_served = 0
+
+    def client(self):
+
+        """A tweepy.API stand-in for one more credential set."""
+
+        return FakeTwitterAPI(self)
+
+    def advance(self, days):
+        self.clock += datetime.timedelta(days=days)
+
+    def user_index(self, twitter_id=None, screen_name=None):
+        if screen_name is not None:
+            prefix = "bench_user_"
+            if not screen_name.lower().startswith(prefix) or not screen_name[len(prefix):].isdigit():
+                return None
+            index = int(screen_name[len(prefix):])
+        else:
+            index = int(twitter_id) - FIRST_USER_ID
+        return index if 0 <= index < self.users else None
+
+    def profile(self, index):
+
+        """The user's fixed characteristics, generated on first use."""
+
+        with self.lock:
+            if index in self.profiles:
+                return self.profiles[index]
+        rng = np.random.default_rng([self.seed, index])
+        kind = rng.random()
+        private = kind < self.private_share
+        empty = not private and kind < self.private_share + self.empty_share
+        rate = 0.0 if empty else float(np.clip(rng.lognormal(0, 1.2), 0.01, 50))
+
+        # tweet times across the whole span, turned into snowflake ids, newest first
+        start_ms = int(self.start.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+        first_ms = start_ms - HISTORY_DAYS * 86400000
+        last_ms = start_ms + FUTURE_DAYS * 86400000
+        count = min(int(rng.poisson(rate * (HISTORY_DAYS + FUTURE_DAYS))), MAX_TWEETS)
+        times = rng.integers(first_ms, last_ms, size=count)
+        tweet_ids = np.sort(((times - poll_scheduler.TWITTER_EPOCH_MS) << 22)
+                            | rng.integers(0, 1 << 22, size=count))[::-1]
+
+        friend_count = int(np.clip(rng.lognormal(np.log(300), 1), 0, 20000))
+        friend_ids = np.unique(rng.zipf(1.4, size=friend_count) % POPULAR_ACCOUNTS) + FIRST_ACCOUNT_ID
+        rng.shuffle(friend_ids)
+
+        profile = {"id": FIRST_USER_ID + index,
+                   "screen_name": f"bench_user_{index}",
+                   "private": private,
+                   "older_tweets": 0 if empty else int(rng.integers(0, 5000)),
+                   "tweet_ids": tweet_ids,
+                   "friend_ids": friend_ids.tolist(),
+                   "followers_count": int(rng.lognormal(np.log(200), 1.5))}
+        with self.lock:
+            return self.profiles.setdefault(index, profile)
+
+    def visible_tweets(self, profile):
+
+        """Ids of the user's tweets posted by now, newest first."""
+
+        clock_ms = int(self.clock.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+        newest = (clock_ms - poll_scheduler.TWITTER_EPOCH_MS) << 22
+        ids = profile["tweet_ids"]
+        return ids[np.searchsorted(-ids, -newest, side="left"):]
+
+    def user_json(self, profile, with_status=True):
+        visible = self.visible_tweets(profile)
+        user = {"id": profile["id"],
+                "id_str": str(profile["id"]),
+                "name": f"Bench User {profile['id'] - FIRST_USER_ID}",
+                "screen_name": profile["screen_name"],
+                "location": "",
+                "description": "A synthetic account served by fake_twitter.",
+                "url": None,
+                "protected": profile["private"],
+                "followers_count": profile["followers_count"],
+                "friends_count": len(profile["friend_ids"]),
+                "listed_count": 0,
+                "created_at": "Mon Jan 04 12:00:00 +0000 2010",
+                "favourites_count": 0,
+                "verified": False,
+                "statuses_count": profile["older_tweets"] + len(visible),
+                "lang": None,
+                "following": False,
+                "default_profile": True}
+        if with_status and len(visible) and not profile["private"]:
+            user["status"] = self.tweet_json(profile, int(visible[0]), None)
+        return user
+
+    def tweet_json(self, profile, tweet_id, user):
+        rng = random.Random(tweet_id)
+        text = " ".join(rng.choice(WORDS) for word in range(rng.randint(5, 40)))
+        tweet = {"created_at": twitter_time(tweet_id),
+                 "id": tweet_id,
+                 "id_str": str(tweet_id),
+                 "full_text": text,
+                 "truncated": False,
+                 "display_text_range": [0, len(text)],
+                 "entities": {"hashtags": [], "symbols": [], "user_mentions": [], "urls": []},
+                 "source": '<a href="https://mobile.twitter.com" rel="nofollow">Twitter Web App</a>',
+                 "in_reply_to_status_id": None,
+                 "in_reply_to_status_id_str": None,
+                 "in_reply_to_user_id": None,
+                 "in_reply_to_user_id_str": None,
+                 "in_reply_to_screen_name": None,
+                 "geo": None,
+                 "coordinates": None,
+                 "place": None,
+                 "contributors": None,
+                 "is_quote_status": False,
+                 "retweet_count": rng.randint(0, 20),
+                 "favorite_count": rng.randint(0, 50),
+                 "favorited": False,
+                 "retweeted": False,
+                 "lang": "en"}
+        if user is not None:
+            tweet["user"] = user
+        return tweet
+
+    def count(self, endpoint, tweets=0, payload=""):
+        with self.lock:
+            self.requests[endpoint] += 1
+            self.tweets_served += tweets
+            self.bytes_served += len(payload)
+
+    def stats(self):
+        with self.lock:
+            return {"requests": sum(self.requests.values()),
+                    "by_endpoint": dict(self.requests),
+                    "errors": dict(self.errors),
+                    "tweets": self.tweets_served,
+                    "bytes": self.bytes_served}
+
+
+class FakeTwitterAPI:
+
+    """A client of a FakeTwitter, answering the tweepy.API methods that
+    twitter_ops uses with the same types tweepy would.
+
+    Each call waits the service's latency (give or take half), may fail with
+    a 503 at the service's error rate, and counts against this client's own
+    limit for the endpoint's window, failing with a 429 over the limit as
+    Twitter does. Responses are made as JSON text and parsed back, as tweepy
+    parses real responses, unless the client is a raw_json() one."""
+
+    def __init__(self, service, raw=False, windows=None):
+        self.service = service
+        self.raw = raw
+        self.auth = None
+        self.windows = windows if windows is not None else {}
+        self.lock = threading.Lock()
+        self.random = random.Random()
+        self.local = threading.local()
+
+    @property
+    def last_response(self):
+
+        """The last response received by this thread."""
+
+        return getattr(self.local, "response", None)
+
+    def raw_json(self):
+
+        """A client that returns timelines as undecoded JSON text (tweepy's RawParser),
+        sharing this client's rate limit windows."""
+
+        return FakeTwitterAPI(self.service, raw=True, windows=self.windows)
+
+    def call(self, endpoint):
+
+        """The cost of a request: latency, a possible error, and the rate limit."""
+
+        service = self.service
+        if service.latency:
+            time.sleep(service.latency * (0.5 + self.random.random()))
+        with self.lock:
+            now = time.time()
+            used, reset = self.windows.get(endpoint, (0, now + service.window))
+            if now >= reset:
+                used, reset = 0, now + service.window
+            limit = service.limits.get(endpoint)
+            if limit is not None and used >= limit:
+                headers = {"x-rate-limit-limit": str(limit), "x-rate-limit-remaining": "0",
+                           "x-rate-limit-reset": str(math.ceil(reset))}
+                with service.lock:
+                    service.errors[429] += 1
+                raise tweepy.RateLimitError("Rate limit exceeded", FakeResponse(429, headers), api_code=88)
+            self.windows[endpoint] = (used + 1, reset)
+            headers = {"x-rate-limit-limit": str(limit), "x-rate-limit-remaining": str((limit or 0) - used - 1),
+                       "x-rate-limit-reset": str(math.ceil(reset))}
+            failed = self.random.random() < service.error_rate
+        if failed:
+            with service.lock:
+                service.errors[503] += 1
+            raise tweepy.TweepError("Over capacity", FakeResponse(503, headers), api_code=130)
+        self.local.response = FakeResponse(200, headers)
+
+    def served(self, endpoint, tweets, payload):
+        self.service.count(endpoint, tweets, payload)
+        self.last_response.headers["content-length"] = str(len(payload))
+
+    def not_authorized(self):
+        with self.service.lock:
+            self.service.errors[401] += 1
+        return tweepy.TweepError("Not authorized.", FakeResponse(401))
+
+    def user_timeline(self, id=None, user_id=None, count=20, since_id=None, max_id=None, **kwargs):
+        self.call("/statuses/user_timeline")
+        index = self.service.user_index(id or user_id)
+        if index is None:
+            raise tweepy.TweepError("Sorry, that page does not exist.", FakeResponse(404), api_code=34)
+        profile = self.service.profile(index)
+        if profile["private"]:
+            raise self.not_authorized()
+        ids = self.service.visible_tweets(profile)[:TIMELINE_DEPTH]
+        if max_id is not None:
+            ids = ids[ids <= max_id]
+        if since_id is not None:
+            ids = ids[ids > since_id]
+        user = self.service.user_json(profile, with_status=False)
+        page = [self.service.tweet_json(profile, int(tweet_id), user) for tweet_id in ids[:min(count, 200)]]
+        payload = json.dumps(page)
+        self.served("/statuses/user_timeline", len(page), payload)
+        if self.raw:
+            return payload
+        return [tweepy.models.Status.parse(None, tweet) for tweet in json.loads(payload)]
+
+    def lookup_users(self, user_ids=None, screen_names=None, **kwargs):
+        self.call("/users/lookup")
+        if screen_names is not None:
+            indices = [self.service.user_index(screen_name=name) for name in screen_names[:100]]
+        else:
+            indices = [self.service.user_index(twitter_id) for twitter_id in (user_ids or [])[:100]]
+        users = [self.service.user_json(self.service.profile(index)) for index in indices if index is not None]
+        payload = json.dumps(users)
+        self.served("/users/lookup", 0, payload)
+        if not users:
+            raise tweepy.TweepError("No user matches for specified terms.", FakeResponse(404), api_code=17)
+        return [tweepy.models.User.parse(None, user) for user in json.loads(payload)]
+
+    def get_user(self, id=None, user_id=None, screen_name=None, **kwargs):
+        self.call("/users/show/:id")
+        index = self.service.user_index(id or user_id, screen_name)
+        if index is None:
+            raise tweepy.TweepError("User not found.", FakeResponse(404), api_code=50)
+        payload = json.dumps(self.service.user_json(self.service.profile(index)))
+        self.served("/users/show/:id", 0, payload)
+        return tweepy.models.User.parse(None, json.loads(payload))
+
+    def friends_ids(self, id=None, user_id=None, count=5000, cursor=None, **kwargs):
+        self.call("/friends/ids")
+        index = self.service.user_index(id or user_id)
+        if index is None:
+            raise tweepy.TweepError("Sorry, that page does not exist.", FakeResponse(404), api_code=34)
+        profile = self.service.profile(index)
+        if profile["private"]:
+            raise self.not_authorized()
+        # cursors are 1 + the offset into the list; -1 is the first page and 0 the end
+        offset = 0 if cursor in (None, -1) else cursor - 1
+        page = profile["friend_ids"][offset:offset + min(count, 5000)]
+        next_offset = offset + len(page)
+        next_cursor = next_offset + 1 if next_offset < len(profile["friend_ids"]) else 0
+        previous_cursor = -(offset + 1) if offset else 0
+        payload = json.dumps({"ids": page, "next_cursor": next_cursor, "previous_cursor": previous_cursor})
+        self.served("/friends/ids", 0, payload)
+        ids = json.loads(payload)["ids"]
+        if cursor is None:
+            return ids
+        return ids, (previous_cursor, next_cursor)
+
+    def rate_limit_status(self, **kwargs):
+        self.call("/application/rate_limit_status")
+        now = time.time()
+        families = collections.defaultdict(dict)
+        with self.lock:
+            for endpoint, limit in self.service.limits.items():
+                used, reset = self.windows.get(endpoint, (0, now + self.service.window))
+                if now >= reset:
+                    used, reset = 0, now + self.service.window
+                families[endpoint.split("/")[1]][endpoint] = {"limit": limit, "remaining": limit - used,
+                                                              "reset": math.ceil(reset)}
+        return {"resources": dict(families)}
+
+    def verify_credentials(self, **kwargs):
+        return tweepy.models.User.parse(None, self.service.user_json(self.service.profile(0)))
@@ -0,0 +1,77 @@
+import datetime
+
+import pymongo
+
+
+class HarvestJournal:
+
+    """Per-user progress of a harvest run, kept in MongoDB.
+
+    Each run has a document in harvest_runs, and each of its users an entry in
+    harvest_journal that is "pending" until their timeline is finished. During
+    pagination the entry holds the newest tweet id seen and the max_id reached,
+    so a run that dies (process killed, mongod restarted) is picked up by the
+    next run at the same user and the same page instead of starting again."""
+
+    def __init__(self, db):
+        self.runs = db.harvest_runs
+        self.entries = db.harvest_journal
+        self.run_id = None
+
+    def open(self, users_to_follow):
+
+        """Resume the unfinished run if there is one, otherwise start a new one.
+        Returns the users still to be harvested, in list order."""
+
+        self.entries.create_index([("run_id", pymongo.ASCENDING),
+                                   ("user_id", pymongo.ASCENDING)], unique=True)
+        unfinished = self.runs.find_one({"status": "running"}, sort=[("started", pymongo.DESCENDING)])
+
+        if unfinished is not None:
+            self.run_id = unfinished["_id"]
+            # users added to the list since the run started join it as pending
+            self.entries.bulk_write([pymongo.UpdateOne({"run_id": self.run_id, "user_id": twitter_id},
+                                                       {"$setOnInsert": {"state": "pending"}},
+                                                       upsert=True)
+                                     for twitter_id in users_to_follow], ordered=False)
+            done = {entry["user_id"] for entry in
+                    self.entries.find({"run_id": self.run_id, "state": "done"}, {"user_id": 1})}
+            pending = [twitter_id for twitter_id in users_to_follow if twitter_id not in done]
+            print(f"Resuming interrupted harvest from {unfinished['started']}: "
+                  f"{len(pending)} of {len(users_to_follow)} users left.")
+            return pending
+
+        self.run_id = self.runs.insert_one({"started": datetime.datetime.utcnow(),
+                                            "status": "running",
+                                            "user_count": len(users_to_follow)}).inserted_id
+        if users_to_follow:
+            self.entries.insert_many([{"run_id": self.run_id, "user_id": twitter_id, "state": "pending"}
+                                      for twitter_id in users_to_follow], ordered=False)
+        return list(users_to_follow)
+
+    def progress(self, twitter_id):
+
+        """Where pagination of a user got to in this run, if it started:
+        the since_id it was paging back to, the newest_id seen and the max_id reached."""
+
+        return self.entries.find_one({"run_id": self.run_id, "user_id": twitter_id,
+                                      "max_id": {"$exists": True}})
+
+    def record_page(self, twitter_id, since_id, newest_id, max_id):
+        self.entries.update_one({"run_id": self.run_id, "user_id": twitter_id},
+                                {"$set": {"since_id": since_id, "newest_id": newest_id, "max_id": max_id}})
+
+    def mark_done(self, twitter_ids, status):
+        if twitter_ids:
+            self.entries.update_many({"run_id": self.run_id, "user_id": {"$in": list(twitter_ids)}},
+                                     {"$set": {"state": "done", "status": status},
+                                      "$unset": {"since_id": "", "newest_id": "", "max_id": ""}})
+
+    def close(self):
+
+        """Mark the run finished and drop its per-user entries."""
+
+        self.runs.update_one({"_id": self.run_id},
+                             {"$set": {"status": "finished",
+                                       "finished": datetime.datetime.utcnow()}})
+        self.entries.delete_many({"run_id": self.run_id})
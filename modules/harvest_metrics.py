@@ -0,0 +1,185 @@
+import collections
+import datetime
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# upper bounds (seconds) of the request latency histogram buckets; the last bucket is everything slower
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class HarvestMetrics:
+
+    """Counts of what the API requests of a harvest cost, by endpoint and by user.
+
+    For each endpoint: requests, failed requests, retries, bytes received,
+    seconds spent in requests (with a latency histogram) and seconds spent
+    waiting for rate limit budget. For each user: tweets fetched from the API
+    and tweets newly inserted. Every value is a running total, so what
+    happened between two snapshots is their difference (see since).
+    Everything counted is also counted in parent, if there is one, so a run
+    can be measured on its own while the process totals stay complete."""
+
+    def __init__(self, parent=None):
+        self.lock = threading.Lock()
+        self.endpoints = collections.defaultdict(new_endpoint)
+        self.users = {}
+        self.parent = parent
+
+    def request(self, endpoint, seconds, received=0, failed=False):
+        if self.parent is not None:
+            self.parent.request(endpoint, seconds, received, failed)
+        with self.lock:
+            counts = self.endpoints[endpoint]
+            counts["requests"] += 1
+            counts["errors"] += int(failed)
+            counts["bytes"] += received
+            counts["seconds"] += seconds
+            counts["latency_buckets"][bucket(seconds)] += 1
+
+    def retry(self, endpoint):
+        if self.parent is not None:
+            self.parent.retry(endpoint)
+        with self.lock:
+            self.endpoints[endpoint]["retries"] += 1
+
+    def wait(self, endpoint, seconds):
+        if self.parent is not None:
+            self.parent.wait(endpoint, seconds)
+        with self.lock:
+            self.endpoints[endpoint]["wait_seconds"] += seconds
+
+    def user(self, twitter_id, fetched, inserted):
+        if self.parent is not None:
+            self.parent.user(twitter_id, fetched, inserted)
+        with self.lock:
+            previous_fetched, previous_inserted = self.users.get(str(twitter_id), (0, 0))
+            self.users[str(twitter_id)] = (previous_fetched + fetched, previous_inserted + inserted)
+
+    def snapshot(self):
+        with self.lock:
+            return {"endpoints": {endpoint: dict(counts, latency_buckets=list(counts["latency_buckets"]))
+                                  for endpoint, counts in self.endpoints.items()},
+                    "users": {twitter_id: list(counts) for twitter_id, counts in self.users.items()}}
+
+
+def new_endpoint():
+    return {"requests": 0, "errors": 0, "retries": 0, "bytes": 0, "seconds": 0.0, "wait_seconds": 0.0,
+            "latency_buckets": [0] * (len(LATENCY_BUCKETS) + 1)}
+
+
+def bucket(seconds):
+    for number, bound in enumerate(LATENCY_BUCKETS):
+        if seconds <= bound:
+            return number
+    return len(LATENCY_BUCKETS)
+
+
+# shared by every CredentialPool in the process unless it is given its own
+process_metrics = HarvestMetrics()
+
+# metrics servers already running, by port
+servers = {}
+
+
+def since(earlier, later):
+
+    """What happened between two snapshots of the same HarvestMetrics."""
+
+    def subtract(before, after):
+        if isinstance(after, dict):
+            return {key: subtract(before.get(key) if before else None, value) for key, value in after.items()}
+        if isinstance(after, list):
+            return [subtract(before[index] if before else None, value) for index, value in enumerate(after)]
+        return after - (before or 0)
+
+    difference = subtract(earlier, later)
+    # users with nothing new in between drop out
+    difference["users"] = {twitter_id: counts for twitter_id, counts in difference["users"].items() if any(counts)}
+    return difference
+
+
+def quantile(buckets, share):
+
+    """The upper bound of the latency bucket holding the given share of requests."""
+
+    total = sum(buckets)
+    if not total:
+        return None
+    seen = 0
+    for number, count in enumerate(buckets):
+        seen += count
+        if seen >= share * total:
+            return LATENCY_BUCKETS[number] if number < len(LATENCY_BUCKETS) else float("inf")
+
+
+def summary(snapshot):
+
+    """A snapshot with averages, latency quantiles and totals worked out."""
+
+    endpoints = {}
+    for endpoint, counts in snapshot["endpoints"].items():
+        requests = counts["requests"]
+        endpoints[endpoint] = dict(counts,
+                                   mean_seconds=round(counts["seconds"] / requests, 3) if requests else None,
+                                   p50_seconds=quantile(counts["latency_buckets"], 0.5),
+                                   p95_seconds=quantile(counts["latency_buckets"], 0.95),
+                                   p99_seconds=quantile(counts["latency_buckets"], 0.99))
+    fetched = sum(counts[0] for counts in snapshot["users"].values())
+    inserted = sum(counts[1] for counts in snapshot["users"].values())
+    return {"endpoints": endpoints,
+            "buckets": [str(bound) for bound in LATENCY_BUCKETS] + ["inf"],
+            "totals": {"requests": sum(counts["requests"] for counts in endpoints.values()),
+                       "errors": sum(counts["errors"] for counts in endpoints.values()),
+                       "retries": sum(counts["retries"] for counts in endpoints.values()),
+                       "bytes": sum(counts["bytes"] for counts in endpoints.values()),
+                       "request_seconds": round(sum(counts["seconds"] for counts in endpoints.values()), 1),
+                       "wait_seconds": round(sum(counts["wait_seconds"] for counts in endpoints.values()), 1),
+                       "users": len(snapshot["users"]),
+                       "tweets_fetched": fetched,
+                       "tweets_inserted": inserted}}
+
+
+def save_run(runs_collection, run, earlier, later):
+
+    """Store one harvest's metrics (the difference of two snapshots) in runs_collection,
+    along with run, a dict describing the run. Returns the document's summary."""
+
+    metrics = since(earlier, later)
+    document = dict(run, recorded=datetime.datetime.utcnow(), **summary(metrics))
+    document["users"] = metrics["users"] # {user id: [tweets fetched, tweets inserted]}
+    runs_collection.insert_one(document)
+    return document
+
+
+def serve(metrics, port):
+
+    """Serve metrics as JSON at http://localhost:port/metrics from a background thread.
+    Only one server is started per port, however often this is called."""
+
+    if port in servers:
+        return servers[port]
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.rstrip("/") not in ("", "/metrics"):
+                self.send_error(404)
+                return
+            snapshot = metrics.snapshot()
+            body = json.dumps(dict(summary(snapshot), users=snapshot["users"]), default=str).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # requests for metrics would otherwise fill the epicosm log
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    servers[port] = server
+    print(f"Harvest metrics available at http://localhost:{port}/metrics")
+    return server
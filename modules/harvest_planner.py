@@ -0,0 +1,174 @@
+import datetime
+import math
+
+import numpy as np
+
+from modules import rate_limit
+
+
+TIMELINE_DEPTH = 3200      # Twitter serves no further back than this many tweets
+TIMELINE_PAGE = 200
+FRIENDS_PAGE = 5000
+LOOKUP_BATCH = 100
+DEFAULT_RATE = 1.0         # tweets per day assumed for users we know nothing about
+
+# seconds per request, when there are no stored runs to measure it from
+DEFAULT_LATENCY = {"/statuses/user_timeline": 0.6,
+                   "/users/lookup": 0.4,
+                   "/friends/ids": 0.3}
+
+
+def phase_time(requests, endpoint, credentials, concurrency, latency, window=rate_limit.WINDOW_SECONDS):
+
+    """How long requests to endpoint take, and how many rate limit windows they span.
+
+    Each window allows the endpoint's limit per credential set; within it,
+    requests go at concurrency / latency per second until the budget is spent,
+    then wait for the next window."""
+
+    if requests <= 0:
+        return 0.0, 0
+    speed = concurrency / latency
+    per_window = min(rate_limit.ENDPOINT_LIMITS[endpoint] * credentials, speed * window)
+    full_windows = math.ceil(requests / per_window) - 1
+    rest = requests - full_windows * per_window
+    return full_windows * window + rest / speed, full_windows + 1
+
+
+def measured_latency(runs_collection):
+
+    """Mean request latency per endpoint over the most recent stored runs,
+    or the defaults for endpoints that have not been measured."""
+
+    latency = dict(DEFAULT_LATENCY)
+    requests = {}
+    seconds = {}
+    for run in runs_collection.find({}, {"endpoints": 1}).sort("recorded", -1).limit(20):
+        for endpoint, counts in run.get("endpoints", {}).items():
+            requests[endpoint] = requests.get(endpoint, 0) + counts.get("requests", 0)
+            seconds[endpoint] = seconds.get(endpoint, 0) + counts.get("seconds", 0)
+    for endpoint in requests:
+        if requests[endpoint] >= 10:
+            latency[endpoint] = seconds[endpoint] / requests[endpoint]
+    return latency
+
+
+def profile_rate(profile, now):
+
+    """Tweets per day over the life of an account, from its profile."""
+
+    try:
+        created = datetime.datetime.strptime(profile["created_at"], "%a %b %d %H:%M:%S +0000 %Y")
+    except (KeyError, TypeError, ValueError):
+        return None
+    return profile.get("statuses_count", 0) / max((now - created).days, 1)
+
+
+def user_statistics(users_to_follow, db):
+
+    """What is known about each user: their harvest cursor, last profile seen and
+    stored friend list size. Users never harvested get a posting rate from their
+    profile, or the median of those that have been."""
+
+    now = datetime.datetime.utcnow()
+    cursors = {cursor["_id"]: cursor for cursor in db.harvest_cursors.find({"_id": {"$in": users_to_follow}})}
+    profiles = {known["id"]: known.get("profile") or {} for known in
+                db.screen_names.find({"id": {"$in": users_to_follow}}, {"id": 1, "profile": 1})}
+    friends = {stored["user_id"]: stored.get("friends_count") for stored in
+               db.friends.find({"user_id": {"$in": users_to_follow}}, {"user_id": 1, "friends_count": 1})}
+
+    known_rates = [cursor["rate"] for cursor in cursors.values() if cursor.get("rate") is not None]
+    typical_rate = float(np.median(known_rates)) if known_rates else DEFAULT_RATE
+    statistics = []
+    for twitter_id in users_to_follow:
+        cursor = cursors.get(twitter_id)
+        profile = profiles.get(twitter_id, {})
+        rate = cursor.get("rate") if cursor else None
+        if rate is None:
+            rate = profile_rate(profile, now)
+        statistics.append({"id": twitter_id,
+                           "harvested": cursor is not None and cursor.get("newest_id") is not None,
+                           "status": cursor.get("status") if cursor else None,
+                           "statuses_count": profile.get("statuses_count",
+                                                         cursor.get("statuses_count") if cursor else None),
+                           "friends_count": friends.get(twitter_id, profile.get("friends_count")),
+                           "rate": typical_rate if rate is None else rate})
+    return statistics
+
+
+def plan(run_folder, db, screen_names, credentials, workers, days=3, full_cycle=False):
+
+    """Estimate the requests and wall time of each phase of a harvest of the cohort.
+
+    Returns a list of phases, each a dict of name, endpoint, requests, seconds
+    and windows, using the stored per-user statistics, Twitter's rate limits,
+    the number of credential sets, the number of workers and request latencies
+    measured in previous runs."""
+
+    try:
+        users_to_follow = [int(line.rstrip("\n")) for line in open(run_folder + "/user_list.ids")]
+    except FileNotFoundError:
+        users_to_follow = []
+    statistics = user_statistics(users_to_follow, db)
+    latency = measured_latency(db.runs)
+
+    known_names = {known["_id"] for known in db.screen_names.find({}, {"_id": 1})}
+    unresolved = [name for name in screen_names if name.lower() not in known_names]
+    new_users = [user for user in statistics if not user["harvested"]]
+    harvested = [user for user in statistics if user["harvested"]]
+    unknown = [user for user in new_users if user["statuses_count"] is None]
+
+    def phase(name, endpoint, requests, concurrency, note=""):
+        seconds, windows = phase_time(requests, endpoint, credentials, max(1, concurrency), latency[endpoint])
+        return {"name": name, "endpoint": endpoint, "requests": int(math.ceil(requests)),
+                "seconds": seconds, "windows": windows, "note": note}
+
+    # new users are paged back as far as Twitter allows, plus the empty page that ends it
+    deep_requests = sum(math.ceil(min(TIMELINE_DEPTH if user["statuses_count"] is None
+                                      else user["statuses_count"], TIMELINE_DEPTH) / TIMELINE_PAGE) + 1
+                        for user in new_users)
+    # later cycles ask only users who have posted, for the tweets since last time
+    cycle_requests = 0.0
+    for user in statistics:
+        expected = user["rate"] * days
+        active = 1.0 if full_cycle else 1 - math.exp(-expected)
+        cycle_requests += active * (1 + math.floor(expected / max(active, 1e-9) / TIMELINE_PAGE))
+    friends_requests = sum(max(1, math.ceil((user["friends_count"] or 0) / FRIENDS_PAGE)) for user in statistics)
+    checks = 0 if full_cycle else math.ceil(len(statistics) / LOOKUP_BATCH)
+
+    return [phase("user lookup", "/users/lookup", math.ceil(len(unresolved) / LOOKUP_BATCH), 1,
+                  f"{len(unresolved)} screen names not yet resolved"),
+            phase("activity check", "/users/lookup", checks, 1, "skipped with --full_cycle" if full_cycle else ""),
+            phase("deep harvest", "/statuses/user_timeline", deep_requests, min(workers, len(new_users)),
+                  f"{len(new_users)} new users" + (f", {len(unknown)} assumed to have {TIMELINE_DEPTH}+ tweets"
+                                                   if unknown else "")),
+            phase(f"{days:g}-day cycle", "/statuses/user_timeline", cycle_requests, min(workers, len(statistics)),
+                  f"{len(harvested)} users with history, {len(new_users)} at estimated rates"),
+            phase("friends", "/friends/ids", friends_requests, 1, f"every friend list, {len(statistics)} users")]
+
+
+def duration(seconds):
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
+def print_plan(phases, credentials, workers, rerun):
+
+    """Print a plan from plan(), and how the deep harvest would go with other
+    numbers of credential sets (rerun(credentials) gives the phases for that many)."""
+
+    print(f"Harvest plan with {credentials} credential set(s) and {workers} worker(s):")
+    for phase in phases:
+        print(f"  {phase['name']:<16} {phase['requests']:>9} requests to {phase['endpoint']:<24} "
+              f"{duration(phase['seconds']):>16}  over {phase['windows']} rate limit window(s)"
+              f"{'  (' + phase['note'] + ')' if phase['note'] else ''}")
+    times = {phase["name"]: phase["seconds"] for phase in phases}
+    cycle = next(phase for phase in phases if phase["name"].endswith("cycle"))
+    first_run = times["user lookup"] + times["activity check"] + times["deep harvest"]
+    print(f"First harvest: about {duration(first_run)}; each later cycle: about "
+          f"{duration(times['activity check'] + cycle['seconds'])}.")
+    print(f"Friend lists take {duration(times['friends'])} after the harvest, or overlap it with --with_friends "
+          f"(about {duration(max(first_run, times['friends']))} together).")
+    for more in (1, 2, 4, 8):
+        if more != credentials:
+            deep = next(phase for phase in rerun(more) if phase["name"] == "deep harvest")
+            print(f"  with {more} credential set(s) the deep harvest would take about {duration(deep['seconds'])}")
@@ -0,0 +1,142 @@
+import threading
+import types
+
+import requests
+import tweepy
+from requests.adapters import HTTPAdapter
+
+
+API_ROOT = "https://api.twitter.com/1.1"
+
+
+class PooledTransport:
+
+    """One requests.Session for all API requests, with a pool of kept-alive connections.
+
+    tweepy 3.10 makes a new Session, and so a new connection and TLS handshake,
+    for every request. Here connections are kept open and reused, up to
+    pool_size at once (one per harvest worker is enough), and responses come
+    gzip-compressed. Counts of requests, connections opened and bytes before
+    and after decompression show how much reuse and compression save."""
+
+    def __init__(self, pool_size=10, timeout=60):
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=0)
+        self.session.mount("https://", self.adapter)
+        self.session.headers.update({"Accept-Encoding": "gzip", "Connection": "keep-alive"})
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+
+    def request(self, method, path, oauth, params):
+        response = self.session.request(method, API_ROOT + path, auth=oauth, timeout=self.timeout,
+                                        params=params if method == "GET" else None,
+                                        data=params if method == "POST" else None)
+        body = response.content
+        with self.lock:
+            self.requests += 1
+            self.wire_bytes += int(response.headers.get("content-length", len(body)))
+            self.decoded_bytes += len(body)
+        return response
+
+    def stats(self):
+
+        """Requests made, connections opened to make them, and bytes received."""
+
+        connections = 0
+        pool_requests = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            connections += pool.num_connections
+            pool_requests += pool.num_requests
+        with self.lock:
+            return {"requests": self.requests,
+                    "connections": connections,
+                    "requests_per_connection": round(pool_requests / connections, 1) if connections else None,
+                    "wire_bytes": self.wire_bytes,
+                    "decoded_bytes": self.decoded_bytes}
+
+
+class PooledTwitterAPI:
+
+    """A stand-in for tweepy.API, for one credential set, that sends the requests
+    harvests make through a PooledTransport.
+
+    The methods take the same arguments and return the same models as tweepy's,
+    parsed by tweepy's own parser, and failures raise the same TweepError and
+    RateLimitError. Rate limit waiting and retries are left to the
+    CredentialPool, so tweepy's wait_on_rate_limit and retry arguments are
+    accepted and ignored. With raw, timelines come back as undecoded JSON text."""
+
+    def __init__(self, auth, transport, raw=False):
+        self.auth = auth
+        self.oauth = auth.apply_auth()
+        self.transport = transport
+        self.raw = raw
+        self.parser = tweepy.parsers.ModelParser()
+        self.local = threading.local()
+
+    @property
+    def last_response(self):
+
+        """The last response received by this thread."""
+
+        return getattr(self.local, "response", None)
+
+    def raw_json(self):
+        return PooledTwitterAPI(self.auth, self.transport, raw=True)
+
+    def call(self, method, path, params, payload_type, payload_list=False, return_cursors=False, raw=False):
+        params = {key: ("true" if value else "false") if isinstance(value, bool) else value
+                  for key, value in params.items() if value is not None}
+        try:
+            response = self.transport.request(method, path, self.oauth, params)
+        except requests.RequestException as e: # as tweepy reports connection failures
+            raise tweepy.TweepError("Failed to send request: %s" % e)
+        self.local.response = response
+        if not 200 <= response.status_code < 300:
+            try:
+                message, api_code = self.parser.parse_error(response.text)
+            except Exception:
+                message = "Twitter error response: status code = %s" % response.status_code
+                api_code = None
+            if response.status_code == 429 or tweepy.error.is_rate_limit_error_message(message):
+                raise tweepy.RateLimitError(message, response, api_code=api_code)
+            raise tweepy.TweepError(message, response, api_code=api_code)
+        if raw:
+            return response.text
+        method = types.SimpleNamespace(api=self, payload_type=payload_type, payload_list=payload_list)
+        return self.parser.parse(method, response.text, return_cursors=return_cursors)
+
+    def user_timeline(self, id=None, user_id=None, screen_name=None, since_id=None, max_id=None, count=None,
+                      include_rts=None, trim_user=None, exclude_replies=None, tweet_mode=None, **ignored):
+        return self.call("GET", "/statuses/user_timeline.json",
+                         {"user_id": user_id or id, "screen_name": screen_name, "since_id": since_id,
+                          "max_id": max_id, "count": count, "include_rts": include_rts, "trim_user": trim_user,
+                          "exclude_replies": exclude_replies, "tweet_mode": tweet_mode},
+                         "status", payload_list=True, raw=self.raw)
+
+    def lookup_users(self, user_ids=None, screen_names=None, include_entities=None, tweet_mode=None, **ignored):
+        return self.call("POST", "/users/lookup.json",
+                         {"user_id": ",".join(map(str, user_ids)) if user_ids else None,
+                          "screen_name": ",".join(screen_names) if screen_names else None,
+                          "include_entities": include_entities, "tweet_mode": tweet_mode},
+                         "user", payload_list=True)
+
+    def get_user(self, id=None, user_id=None, screen_name=None, **ignored):
+        return self.call("GET", "/users/show.json",
+                         {"user_id": user_id or id, "screen_name": screen_name}, "user")
+
+    def friends_ids(self, id=None, user_id=None, screen_name=None, cursor=None, count=None, **ignored):
+        return self.call("GET", "/friends/ids.json",
+                         {"user_id": user_id or id, "screen_name": screen_name, "cursor": cursor, "count": count},
+                         "ids", return_cursors=cursor is not None)
+
+    def rate_limit_status(self, resources=None, **ignored):
+        return self.call("GET", "/application/rate_limit_status.json", {"resources": resources}, "json")
+
+    def verify_credentials(self, **ignored):
+        return self.call("GET", "/account/verify_credentials.json", {}, "user")
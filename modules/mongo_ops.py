@@ -5,10 +5,8 @@ import time
 import psutil
 import pymongo
 
-#import mongodb_config
-client = pymongo.MongoClient("localhost", 27017)
-db = client.twitter_db
-collection = db.tweets
+from modules import db_migrations, mongodb_config
+
 
 def mongo_checks():
 
@@ -39,62 +37,177 @@ def mongo_checks():
     return mongod_executable_path, mongoexport_executable_path, mongodump_executable_path, mongoimport_executable_path
 
 
+# the mongod started by this process, if it started one
+mongod_process = None
+
+
+def ping(timeout=0.5):
+
+    """True if MongoDB answers a ping within timeout seconds.
+
+    A throwaway client is used, so that a mongod that is down or still starting
+    fails fast rather than after the shared client's selection timeout."""
+
+    probe = pymongo.MongoClient(mongodb_config.settings["host"], mongodb_config.settings["port"],
+                                serverSelectionTimeoutMS=int(timeout * 1000),
+                                connectTimeoutMS=int(timeout * 1000))
+    try:
+        probe.admin.command("ping")
+        return True
+    except pymongo.errors.PyMongoError:
+        return False
+    finally:
+        probe.close()
+
+
+def mongo_running():
+
+    """Liveness check: is MongoDB up and answering on the configured port?"""
+
+    return ping()
+
+
+def running_db_path():
+
+    """The data folder of the mongod answering on the configured port, or None."""
+
+    try:
+        options = mongodb_config.client.admin.command("getCmdLineOpts")
+        return options["parsed"].get("storage", {}).get("dbPath")
+    except pymongo.errors.PyMongoError:
+        return None
+
+
+def log_tail(log_filename, lines=5):
+    try:
+        with open(log_filename) as log:
+            return "".join(log.readlines()[-lines:])
+    except OSError:
+        return ""
+
+
 def start_mongo(mongod_executable_path, db_path, db_log_filename, epicosm_log_filename):
 
-    """Spin up a MongoDB daemon (mongod) from the shell.
+    """Spin up a MongoDB daemon (mongod) and wait until it is ready.
 
     The db path is set as suitable to the environment (locally in the
     folder it is run in, but docker in the volumes folder).
-    pgrep will look for running mongod processes and inform of conflicts,
-    but this might throw an error if it comes across a zombie, in which case
-    it ignores it and carries on with starting the daemon."""
+    If a mongod already answers on the port it is used as it is. Otherwise
+    readiness is a successful ping, retried with backoff for up to
+    mongodb_config.settings["startup_timeout"] seconds, since a big database
+    recovering from an unclean shutdown can take minutes before it accepts
+    connections. The WiredTiger cache size and journal commit interval come
+    from mongodb_config.settings; None leaves mongod's defaults."""
+
+    global mongod_process
+    settings = mongodb_config.settings
+
+    if ping():
+        running_path = running_db_path()
+        if running_path and os.path.realpath(running_path) != os.path.realpath(db_path):
+            print(f"A MongoDB is already running on port {settings['port']}, but with its data in "
+                  f"{running_path}, not {db_path}. Epicosm will use it as it is.")
+        else:
+            print(f"MongoDB is already running.")
+        return
+
+    # mongod.lock holds the pid of a running mongod and is emptied by a clean shutdown
+    lock_file = os.path.join(db_path, "mongod.lock")
+    recovering = os.path.isfile(lock_file) and os.path.getsize(lock_file) > 0
 
+    command = [mongod_executable_path, "--dbpath", db_path, "--logpath", db_log_filename,
+               "--port", str(settings["port"])]
+    if settings["cache_gb"]:
+        command += ["--wiredTigerCacheSizeGB", str(settings["cache_gb"])]
+    if settings["journal_commit_ms"]:
+        command += ["--journalCommitInterval", str(settings["journal_commit_ms"])]
 
-    print(f"Starting the MongoDB daemon...")
+    print(f"Starting the MongoDB daemon{', which will first recover from an unclean shutdown' if recovering else ''}...")
+    started = time.time()
     try:
-        subprocess.Popen([mongod_executable_path, "--dbpath",
-                          db_path, "--logpath", db_log_filename],
-                          stdout = open(epicosm_log_filename, "a+"))
-        time.sleep(1)
-    except subprocess.CalledProcessError as e:
-        print(f"Problem starting MongoDB:", e.output)
+        mongod_process = subprocess.Popen(command, stdout=open(epicosm_log_filename, "a+"))
+    except OSError as e:
+        print(f"Problem starting MongoDB:", e)
         sys.exit()
 
+    delay = 0.05
+    while not ping():
+        if mongod_process.poll() is not None:
+            print(f"MongoDB stopped while starting (exit code {mongod_process.returncode}). "
+                  f"The end of its log, {db_log_filename}:\n{log_tail(db_log_filename)}")
+            sys.exit()
+        if time.time() - started > settings["startup_timeout"]:
+            print(f"MongoDB was not ready after {settings['startup_timeout']}s, and is left running "
+                  f"in case it is still recovering (see {db_log_filename}). Stopping.")
+            sys.exit()
+        time.sleep(delay)
+        delay = min(delay * 2, 2)
+    print(f"MongoDB ready in {time.time() - started:.1f}s"
+          f"{', after recovering from an unclean shutdown' if recovering else ''}.")
+
 
 def stop_mongo(dbpath):
 
     """ Gracefully close the MongoDB daemon.
 
-    pkill -15 is a standard way of ending mongod, which will close connections
-    cleanly. """
+    SIGTERM is a standard way of ending mongod, which will close connections
+    cleanly. It is sent to the mongod whose pid is in dbpath's mongod.lock,
+    falling back to every mongod (pkill -15) if that cannot be read, and the
+    process is then waited on for up to mongodb_config.settings["stop_timeout"]
+    seconds, so that it has finished writing before anything else starts. """
 
+    global mongod_process
     print(f"Asking MongoDB to close...")
-    client.close()
-    subprocess.call(["pkill", "-15", "mongod"])
-
-    timeout = 60
-    while timeout > 0: # wait one minute for mongod to close
-        try:
-            subprocess.check_output(["pgrep", "mongod"])
-        except subprocess.CalledProcessError:
-            print(f"OK, MongoDB daemon closed.")
-            break
-        time.sleep(1)
-        timeout -= 1
-    if timeout == 0: # wait 1 minutes, then let it go...
+    mongodb_config.close()
+    timeout = mongodb_config.settings["stop_timeout"]
+
+    try:
+        with open(os.path.join(dbpath, "mongod.lock")) as lock_file:
+            pid = int(lock_file.read().strip())
+        mongod = psutil.Process(pid)
+        if "mongod" not in mongod.name(): # a stale lock, and the pid since reused
+            mongod = None
+    except (OSError, ValueError, psutil.Error):
+        mongod = None
+    if mongod is None and mongod_process is not None and mongod_process.poll() is None:
+        mongod = psutil.Process(mongod_process.pid)
+
+    if mongod is None:
+        subprocess.call(["pkill", "-15", "mongod"])
+        while timeout > 0: # wait for every mongod to close
+            try:
+                subprocess.check_output(["pgrep", "mongod"])
+            except subprocess.CalledProcessError:
+                print(f"OK, MongoDB daemon closed.")
+                return
+            time.sleep(1)
+            timeout -= 1
         print(f"MongoDB didn't respond to requests to close... be aware that MongoDB is still running.")
-    return
+        return
+
+    started = time.time()
+    try:
+        mongod.terminate()
+        mongod.wait(timeout)
+    except psutil.NoSuchProcess:
+        pass
+    except psutil.TimeoutExpired:
+        print(f"MongoDB didn't respond to requests to close... be aware that MongoDB is still running.")
+        return
+    if mongod_process is not None:
+        mongod_process.poll() # reap it, if it was ours
+        mongod_process = None
+    print(f"OK, MongoDB daemon closed in {time.time() - started:.1f}s.")
 
 
 def index_mongo(run_folder):
 
-    """Tidy up the database so that upsert operations are faster."""
+    """Build the indexes declared in db_migrations that the database is missing.
 
-    if not os.path.isfile(run_folder + "/db/WiredTiger"):
-        return
-    print(f"Indexing MongoDB...")
-    db.tweets.create_index([("id_str", pymongo.ASCENDING)],
-                           unique=True, dropDups=True)
+    The unique id_str index, which rejects duplicate tweets, is built before
+    returning; per-user indexes are built in the background."""
+
+    return db_migrations.migrate(mongodb_config.db)
 
 
 def export_csv_tweets(mongoexport_executable_path,
@@ -105,7 +218,7 @@ def export_csv_tweets(mongoexport_executable_path,
 
     # export selected fields (specified after --fields) into csv
     print(f"Creating CSV output file...")
-    subprocess.call([mongoexport_executable_path, "--host=127.0.0.1",
+    subprocess.call([mongoexport_executable_path, "--host=" + mongodb_config.address(),
                      "--db", "twitter_db",
                      "--collection", "tweets",
                      "--type=csv",
@@ -123,7 +236,7 @@ def export_csv_friends(mongoexport_executable_path,
 
     # export selected fields (specified after --fields) into csv
     print(f"Creating CSV output file...")
-    subprocess.call([mongoexport_executable_path, "--host=127.0.0.1",
+    subprocess.call([mongoexport_executable_path, "--host=" + mongodb_config.address(),
                      "--db", "twitter_db",
                      "--collection", "friends",
                      "--type=csv",
@@ -133,28 +246,12 @@ def export_csv_friends(mongoexport_executable_path,
                      stderr = open(epicosm_log_filename, "a+"))
 
 
-def backup_db(mongodump_executable_path, database_dump_path, epicosm_log_filename, processtime):
-
-    """ Do a full backup of the database into BSON format """
-
-    print(f"Backing up the database...")
-    subprocess.call([mongodump_executable_path, "-o",
-                     database_dump_path, "--host=127.0.0.1"],
-                     stdout = open(epicosm_log_filename, "a+"),
-                     stderr = open(epicosm_log_filename, "a+"))
-    # mongodb doesn't give a naming option(?), so rename with the timestamp
-    subprocess.call(["mv", database_dump_path + "/twitter_db/tweets.bson",
-                     database_dump_path + "/twitter_db/tweets" + processtime + ".bson"])
-    subprocess.call(["mv", database_dump_path + "/twitter_db/tweets.metadata.json",
-                     database_dump_path + "/twitter_db/tweets" + processtime + ".metadata.json"])
-
-
 def export_latest_tweet(mongoexport_executable_path, epicosm_log_filename):
 
     """Export most recent tweet as csv"""
 
     print(f"Creating CSV output file...")
-    subprocess.call([mongoexport_executable_path, "--host=127.0.0.1",
+    subprocess.call([mongoexport_executable_path, "--host=" + mongodb_config.address(),
                     "--db=geotweets", "--collection=geotweets_collection",
                     "--type=csv", "--out=latest_geotweet.csv",
                     "--fields=created_at,geo.coordinates,text",
@@ -167,7 +264,7 @@ def import_analysed_tweet(mongoimport_executable_path, latest_tweet, epicosm_log
     """Import metrics from sentiment analysis into MongoDB"""
 
     print(f"Importing LIWC analysis output...")
-    subprocess.call([mongoimport_executable_path, "--host=127.0.0.1",
+    subprocess.call([mongoimport_executable_path, "--host=" + mongodb_config.address(),
                     "--db=geotweets", "--collection=geotweets_analysed",
                     "--type=csv", "--headerline", "--file=" + latest_tweet],
                     stdout = open(epicosm_log_filename, "a+"))
@@ -1,13 +1,96 @@
+import os
+import threading
+
 import pymongo
 
-client = pymongo.MongoClient("localhost", 27017)
-db = client.twitter_db
-collection = db.tweets
-friends_collection = db.friends
 
-#db_name = "twitter_db"
-#collection_name = "tweets"
-#mongodb_port = 27017
+# How to reach MongoDB, and how to run the mongod Epicosm starts. Change these
+# with configure() before the client is first used; the host, port and wire
+# compression can also be set in the environment, for a mongod that Epicosm
+# did not start itself.
+settings = {"host": os.environ.get("EPICOSM_MONGO_HOST", "localhost"),
+            "port": int(os.environ.get("EPICOSM_MONGO_PORT", 27017)),
+            "pool_size": 100,              # most connections open at once (pymongo's default)
+            "connect_timeout": 20,         # seconds to open a connection
+            "server_selection_timeout": 30, # seconds to wait for mongod before giving up on an operation
+            "socket_timeout": None,        # seconds to wait on a reply, None for no limit
+            "compressors": os.environ.get("EPICOSM_MONGO_COMPRESSORS"), # e.g. "zstd,zlib"; None for none
+            # for the mongod Epicosm starts (mongo_ops.start_mongo)
+            "cache_gb": None,              # WiredTiger cache size, None for mongod's default (half of RAM less 1GB)
+            "journal_commit_ms": None,     # journal commit interval, None for mongod's default (100ms)
+            "startup_timeout": 600,        # seconds to wait for mongod to be ready, recovery included
+            "stop_timeout": 120}           # seconds to wait for mongod to finish closing
+
+database_name = "twitter_db"
+
+# the collections of twitter_db, by the name they go by in this module
+collections = {"collection": "tweets",
+               "friends_collection": "friends",
+               "friends_history_collection": "friends_history",
+               "friend_edges_collection": "friend_edges",
+               "cofollowed_collection": "cofollowed_accounts",
+               "cofollow_similarity_collection": "cofollow_similarity",
+               "cursor_collection": "harvest_cursors",
+               "screen_name_collection": "screen_names",
+               "stats_collection": "stats"}
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def configure(**changes):
+
+    """Change connection settings (see settings). A client already made keeps
+    its settings until close() is called."""
+
+    unknown = set(changes) - set(settings)
+    if unknown:
+        raise ValueError(f"Unknown MongoDB settings: {', '.join(sorted(unknown))}")
+    settings.update(changes)
+
+
+def address():
+
+    """host:port of MongoDB, for the mongo command line tools."""
+
+    return f"{settings['host']}:{settings['port']}"
+
+
+def get_client():
+
+    """The one MongoClient of the process, made with the current settings when first asked for."""
+
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = pymongo.MongoClient(
+                settings["host"], settings["port"],
+                maxPoolSize=settings["pool_size"],
+                connectTimeoutMS=settings["connect_timeout"] * 1000,
+                serverSelectionTimeoutMS=settings["server_selection_timeout"] * 1000,
+                socketTimeoutMS=settings["socket_timeout"] * 1000 if settings["socket_timeout"] else None,
+                **({"compressors": settings["compressors"]} if settings["compressors"] else {}))
+        return _client
+
+
+def close():
+
+    """Close the client, if one was made; the next use makes a new one."""
+
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+def __getattr__(name):
 
-#db = client[db_name]
-#total_records = db[collection_name].estimated_document_count()
+    # client, db and the collections are made on first use, so importing this is cheap
+    if name == "client":
+        return get_client()
+    if name == "db":
+        return get_client()[database_name]
+    if name in collections:
+        return get_client()[database_name][collections[name]]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,238 @@
+import csv
+import os
+
+import numpy as np
+import pymongo
+from scipy import sparse
+
+from modules import bulk_writer
+
+
+# user pairs compared at once in similar_users; 16 million pairs take 64MB per array
+SIMILARITY_CHUNK_CELLS = 16 * 1024 * 1024
+
+
+def index_friend_edges(friend_edges_collection):
+
+    """One document per (user_id, friend_id): unique, and searchable by either end."""
+
+    friend_edges_collection.create_index([("user_id", pymongo.ASCENDING),
+                                          ("friend_id", pymongo.ASCENDING)], unique=True)
+    friend_edges_collection.create_index([("friend_id", pymongo.ASCENDING)])
+
+
+def store_friend_edges(friend_edges_collection, twitter_id, friend_list, writer=None):
+
+    """Bring a user's edges in line with their current friend list.
+
+    The user's stored edges are compared with the list, and only the follows
+    that are new are inserted and only those that have gone are deleted, in
+    one unordered bulk write (passed to writer, a BulkWriter, if given)."""
+
+    old_friends = {edge["friend_id"] for edge in
+                   friend_edges_collection.find({"user_id": twitter_id}, {"_id": 0, "friend_id": 1})}
+    new_friends = set(friend_list)
+    writes = [pymongo.InsertOne({"user_id": twitter_id, "friend_id": friend_id})
+              for friend_id in new_friends - old_friends]
+    gone = list(old_friends - new_friends)
+    if gone:
+        writes.append(pymongo.DeleteMany({"user_id": twitter_id, "friend_id": {"$in": gone}}))
+    bulk_writer.write(friend_edges_collection, writes, writer)
+
+
+def add_missing_friend_edges(friend_collection, friend_edges_collection, twitter_ids, writer=None):
+
+    """Store edges from the stored friend lists of users who have none yet
+    (lists gathered before --friend_edges was used), without asking the API."""
+
+    with_edges = set(friend_edges_collection.distinct("user_id", {"user_id": {"$in": twitter_ids}}))
+    without_edges = [twitter_id for twitter_id in twitter_ids if twitter_id not in with_edges]
+    for document in friend_collection.find({"user_id": {"$in": without_edges}}, {"_id": 0, "user_id": 1, "friends": 1}):
+        # lists stored before snapshots were one-element arrays, [[id], [id], ...]
+        friend_ids = [friend[0] if isinstance(friend, list) else friend for friend in document.get("friends", [])]
+        if friend_ids:
+            store_friend_edges(friend_edges_collection, document["user_id"], friend_ids, writer)
+
+
+def rebuild_friend_edges(friend_collection, friend_edges_collection, batch_size=1000):
+
+    """Make the edge list again from the friend lists in friend_collection,
+    replacing whatever it held (e.g. after a restore, as backups leave it out).
+    Returns the number of edges stored."""
+
+    friend_edges_collection.drop()
+    index_friend_edges(friend_edges_collection)
+    count = 0
+    writes = []
+    for document in friend_collection.find({}, {"_id": 0, "user_id": 1, "friends": 1}):
+        # lists stored before snapshots were one-element arrays, [[id], [id], ...]
+        friend_ids = {friend[0] if isinstance(friend, list) else friend for friend in document.get("friends", [])}
+        for friend_id in friend_ids:
+            writes.append(pymongo.InsertOne({"user_id": document["user_id"], "friend_id": friend_id}))
+            if len(writes) == batch_size:
+                bulk_writer.write(friend_edges_collection, writes)
+                count += len(writes)
+                writes = []
+    bulk_writer.write(friend_edges_collection, writes)
+    return count + len(writes)
+
+
+def read_follow_edges(friend_collection, friend_edges_collection):
+
+    """All (user_id, friend_id) follow pairs as two int64 arrays.
+
+    Read from the edge list if there is one, otherwise from the per-user
+    friends arrays."""
+
+    users = []
+    friends = []
+    if friend_edges_collection.estimated_document_count() > 0:
+        for edge in friend_edges_collection.find({}, {"_id": 0, "user_id": 1, "friend_id": 1}):
+            users.append(edge["user_id"])
+            friends.append(edge["friend_id"])
+    else:
+        for document in friend_collection.find({}, {"_id": 0, "user_id": 1, "friends": 1}):
+            # lists stored before snapshots were one-element arrays, [[id], [id], ...]
+            friend_ids = [friend[0] if isinstance(friend, list) else friend
+                          for friend in document.get("friends", [])]
+            users.extend([document["user_id"]] * len(friend_ids))
+            friends.extend(friend_ids)
+    return np.array(users, dtype=np.int64), np.array(friends, dtype=np.int64)
+
+
+def follow_graph(users, friends):
+
+    """Build the follow graph from edge arrays.
+
+    Every account, in the cohort or followed by it, gets an index; cohort
+    users come first. Returns the sorted-by-index array of twitter ids, the
+    number of cohort users, and the adjacency matrix as CSR, where
+    row i, column j is 1 if account i follows account j."""
+
+    cohort = np.unique(users)
+    others = np.setdiff1d(np.unique(friends), cohort, assume_unique=True)
+    ids = np.concatenate([cohort, others])
+    # ids is only sorted within each part, so search it through its sort order
+    order = np.argsort(ids, kind="stable")
+    rows = order[np.searchsorted(ids, users, sorter=order)]
+    columns = order[np.searchsorted(ids, friends, sorter=order)]
+    matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, columns)),
+                               shape=(len(ids), len(ids)))
+    matrix.sum_duplicates()
+    return ids, len(cohort), matrix
+
+
+def export_friend_graph(friend_collection, friend_edges_collection, output_prefix):
+
+    """Write the cohort follow graph as a compressed sparse matrix plus id map.
+
+    output_prefix.npz loads with scipy.sparse.load_npz, and output_prefix_ids.csv
+    gives the twitter id and cohort membership of each row/column index."""
+
+    print(f"Exporting friends network...")
+    os.makedirs(os.path.dirname(output_prefix), exist_ok=True)
+    users, friends = read_follow_edges(friend_collection, friend_edges_collection)
+    ids, cohort_size, matrix = follow_graph(users, friends)
+    sparse.save_npz(output_prefix + ".npz", matrix, compressed=True)
+    with open(output_prefix + "_ids.csv", "w", newline="") as id_file:
+        writer = csv.writer(id_file)
+        writer.writerow(["index", "twitter_id", "in_cohort"])
+        for index, twitter_id in enumerate(ids):
+            writer.writerow([index, twitter_id, int(index < cohort_size)])
+    print(f"OK - {matrix.nnz} follows between {len(ids)} accounts written to {output_prefix}.npz")
+
+
+def follow_incidence(users, friends):
+
+    """The cohort users x followed accounts incidence matrix, as CSR.
+
+    Returns the twitter ids of the rows, those of the columns, and the matrix,
+    where row i, column j is 1 if user i follows account j."""
+
+    cohort, rows = np.unique(users, return_inverse=True)
+    accounts, columns = np.unique(friends, return_inverse=True)
+    matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)),
+                               shape=(len(cohort), len(accounts)))
+    matrix.data[:] = 1 # count a follow stored twice only once
+    return cohort, accounts, matrix
+
+
+def top_cofollowed(accounts, matrix, cohort_size, top=1000, min_followers=2):
+
+    """The accounts followed by the most cohort users, most followed first."""
+
+    followers = np.asarray(matrix.sum(axis=0)).ravel()
+    ranked = np.argsort(-followers, kind="stable")[:top]
+    ranked = ranked[followers[ranked] >= min_followers]
+    return [{"_id": int(accounts[column]),
+             "rank": rank + 1,
+             "cohort_followers": int(followers[column]),
+             "cohort_share": float(followers[column] / cohort_size)}
+            for rank, column in enumerate(ranked)]
+
+
+def similar_users(cohort, matrix, neighbours=10, chunk_cells=SIMILARITY_CHUNK_CELLS):
+
+    """Yield, for each cohort user, the users whose follow sets overlap most with theirs.
+
+    Shared follows for every pair are the sparse product of the matrix with its
+    transpose, taken a block of rows at a time (about chunk_cells pairs) so
+    that only that slice of the pairs is in memory at once. Jaccard and cosine
+    similarity follow from the shared counts and each user's number of
+    follows; each user keeps their neighbours most similar users by Jaccard."""
+
+    users = matrix.shape[0]
+    follows = np.asarray(matrix.sum(axis=1)).ravel()
+    transpose = matrix.T.tocsc()
+    keep = min(neighbours, users - 1)
+    chunk_size = max(1, chunk_cells // max(users, 1))
+    for start in range(0, users, chunk_size):
+        rows = np.arange(start, min(start + chunk_size, users))
+        shared = (matrix[start:start + chunk_size] @ transpose).toarray()
+        shared[np.arange(len(rows)), rows] = 0 # a user is not their own neighbour
+        jaccard = shared / (follows[rows, None] + follows[None, :] - shared)
+        if keep > 0:
+            best = np.argpartition(-jaccard, keep - 1, axis=1)[:, :keep]
+            ranking = np.take_along_axis(jaccard, best, axis=1)
+            best = np.take_along_axis(best, np.argsort(-ranking, axis=1, kind="stable"), axis=1)
+        else:
+            best = np.empty((len(rows), 0), dtype=np.int64)
+        for offset, row in enumerate(rows):
+            yield {"_id": int(cohort[row]),
+                   "follows": int(follows[row]),
+                   "similar": [{"user_id": int(cohort[other]),
+                                "shared": int(shared[offset, other]),
+                                "jaccard": float(jaccard[offset, other]),
+                                "cosine": float(shared[offset, other] / np.sqrt(follows[row] * follows[other]))}
+                               for other in best[offset] if shared[offset, other] > 0]}
+
+
+def cofollow_analysis(friend_collection, friend_edges_collection,
+                      cofollowed_collection, similarity_collection,
+                      top=1000, neighbours=10, page_size=1000):
+
+    """Work out which accounts the cohort follows in common and how alike
+    users' follow sets are, replacing the results of any previous analysis.
+
+    cofollowed_collection gets the top accounts by number of cohort followers;
+    similarity_collection gets one document per user with their most similar users."""
+
+    print(f"Analysing co-following in the cohort...")
+    users, friends = read_follow_edges(friend_collection, friend_edges_collection)
+    cohort, accounts, matrix = follow_incidence(users, friends)
+
+    cofollowed_collection.delete_many({})
+    ranked = top_cofollowed(accounts, matrix, len(cohort), top)
+    if ranked:
+        cofollowed_collection.insert_many(ranked)
+
+    similarity_collection.delete_many({})
+    page = []
+    for similarity in similar_users(cohort, matrix, neighbours):
+        page.append(similarity)
+        if len(page) == page_size:
+            similarity_collection.insert_many(page)
+            page = []
+    if page:
+        similarity_collection.insert_many(page)
+    print(f"OK - {len(ranked)} co-followed accounts and similar users for {len(cohort)} users stored.")
@@ -9,6 +9,8 @@ import liwc
 from textblob import TextBlob
 
 from modules import (mongo_ops,
+                    backup_ops,
+                    db_stats,
                     epicosm_meta,
                     twitter_ops,
                     nlp_ops,
@@ -40,6 +42,23 @@ def tweet_or_retweet(db_document_dict):
     return full_text_field
 
 
+def store_analysis(selector, fields, many=False):
+
+    """
+    Set analysis fields on the tweets matching selector, stamping them as modified
+    for the next incremental backup. Tweets already holding exactly these values
+    are left alone, so re-running an analysis does not put every tweet into the
+    next backup.
+    """
+
+    changed = dict(selector, **{"$or": [{field: {"$ne": value}} for field, value in fields.items()]})
+    update = {"$set": fields, "$currentDate": backup_ops.MODIFIED_STAMP}
+    if many:
+        mongodb_config.collection.update_many(changed, update)
+    else:
+        mongodb_config.collection.update_one(changed, update)
+
+
 def mongo_insert_groundtruth(db, total_records):
 
     """
@@ -69,9 +88,8 @@ def mongo_insert_groundtruth(db, total_records):
     # Create or update field (epicosm.groundtruth.gt_stat_1) with values
     for index, user in enumerate(groundtruth_in):
 
-        mongodb_config.collection.update_many({"user.id_str": user.user},
-                              {"$set":
-                              {"epicosm.groundtruth.gt_stat_1": float(user.gt_stat_1)}})
+        store_analysis({"user.id_str": user.user},
+                       {"epicosm.groundtruth.gt_stat_1": float(user.gt_stat_1)}, many=True)
 
         users_with_groundtruth_provided.append(user.user)
 
@@ -126,14 +144,15 @@ def mongo_vader(db, total_records):
             vader_positive = analyser.polarity_scores(full_text_field)["pos"]
             vader_compound = analyser.polarity_scores(full_text_field)["compound"]
 
-            mongodb_config.collection.update_one({"id_str": db_document_dict["id_str"]}, {"$set": {
-                                  "epicosm.vader.negative": vader_negative,
-                                  "epicosm.vader.neutral": vader_neutral,
-                                  "epicosm.vader.positive": vader_positive,
-                                  "epicosm.vader.compound": vader_compound}})
+            store_analysis({"id_str": db_document_dict["id_str"]}, {
+                           "epicosm.vader.negative": vader_negative,
+                           "epicosm.vader.neutral": vader_neutral,
+                           "epicosm.vader.positive": vader_positive,
+                           "epicosm.vader.compound": vader_compound})
             bar()
 
     print(f"OK - Vader sentiment analysis applied to {index + 1} records.")
+    db_stats.record_nlp(mongodb_config.stats_collection, "vader", index + 1)
 
 
 def mongo_labMT(db, total_records):
@@ -165,12 +184,13 @@ def mongo_labMT(db, total_records):
             output_valence = labmt.emotionV(stop_vector, labMTvector)
 
             # insert score into DB
-            mongodb_config.collection.update_one({"id_str": db_document_dict["id_str"]}, {"$set": {
-                                  "epicosm.labMT.emotion_valence": float(format(output_valence, '.4f'))}})
+            store_analysis({"id_str": db_document_dict["id_str"]}, {
+                           "epicosm.labMT.emotion_valence": float(format(output_valence, '.4f'))})
 
             bar()
 
     print(f"OK - labMT sentiment analysis applied to {index + 1} records.")
+    db_stats.record_nlp(mongodb_config.stats_collection, "labmt", index + 1)
 
 
 def mongo_textblob(db, total_records):
@@ -190,12 +210,12 @@ def mongo_textblob(db, total_records):
             blob.noun_phrases
 
             for sentence in blob.sentences:
-                mongodb_config.collection.update_one({"id_str": db_document_dict["id_str"]},
-                                                        {"$set": {"epicosm.textblob":
-                                                        float(format(sentence.sentiment.polarity, '.4f'))}})
+                store_analysis({"id_str": db_document_dict["id_str"]},
+                               {"epicosm.textblob": float(format(sentence.sentiment.polarity, '.4f'))})
             bar()
 
     print(f"OK - TextBlob sentiment analysis applied to {index + 1} records.")
+    db_stats.record_nlp(mongodb_config.stats_collection, "textblob", index + 1)
 
 
 def mongo_liwc(db, total_records):
@@ -240,15 +260,15 @@ def mongo_liwc(db, total_records):
 
             for count_category in text_counts:  # insert the LIWC values as proportion of word_count
 
-                mongodb_config.collection.update_one({"id_str": db_document_dict["id_str"]},
-                                               {"$set":
-                                               {"epicosm.liwc." + count_category:
-                                               float(format((text_counts[count_category] / word_count),
-                                               '.4f'))}})
+                store_analysis({"id_str": db_document_dict["id_str"]},
+                               {"epicosm.liwc." + count_category:
+                               float(format((text_counts[count_category] / word_count),
+                               '.4f'))})
 
             bar()
 
     print(f"OK - LIWC sentiment analysis applied to {index + 1} records.")
+    db_stats.record_nlp(mongodb_config.stats_collection, "liwc", index + 1)
 
 
 def mongo_time_of_day(db, total_records):
@@ -283,13 +303,13 @@ def mongo_nlp_example(db, total_records):
             full_text_field = eval(tweet_or_retweet(db_document_dict))
 
             count = Counter(full_text_field)
-            mongodb_config.collection.update_one({"id_str": db_document_dict["id_str"]},
-                                           {"$set":
-                                           { "epicosm.trivial_nlp.e_ratio":
-                                           float(format(int(count['e']) / int(len(full_text_field)), '.4f'))}})
+            store_analysis({"id_str": db_document_dict["id_str"]},
+                           {"epicosm.trivial_nlp.e_ratio":
+                           float(format(int(count['e']) / int(len(full_text_field)), '.4f'))})
             bar()
 
     print(f"OK - e_ratio analysis applied to {index + 1} records.")
+    db_stats.record_nlp(mongodb_config.stats_collection, "e_ratio", index + 1)
 
 
 def mongo_groundtruth_delta(db, candidate_inference):
@@ -305,8 +325,8 @@ def mongo_groundtruth_delta(db, candidate_inference):
 
             groundtruth_delta = groundtruthfield - candidate_inference_output_field
 
-            mongodb_config.collection.update_one({"id_str": tweet_text["id_str"]}, {"$set": {
-                "epicosm." + candidate_inference + ".groundtruth_delta": format(groundtruth_delta, '.4f')}})
+            store_analysis({"id_str": tweet_text["id_str"]}, {
+                "epicosm." + candidate_inference + ".groundtruth_delta": format(groundtruth_delta, '.4f')})
 
         bar()
 
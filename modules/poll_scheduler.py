@@ -0,0 +1,111 @@
+import datetime
+import heapq
+
+
+TWITTER_EPOCH_MS = 1288834974657   # tweet ids carry their creation time in ms since this epoch
+TWEETS_PER_POLL = 200              # aim to find one full timeline page per poll
+MIN_INTERVAL = datetime.timedelta(hours=1)
+MAX_INTERVAL = datetime.timedelta(days=14)
+RATE_SMOOTHING = 0.5               # weight of the latest harvest in the running rate estimate
+
+
+def tweet_time(tweet_id):
+
+    """The creation time of a tweet, read from its (snowflake) id."""
+
+    return datetime.datetime.utcfromtimestamp(((tweet_id >> 22) + TWITTER_EPOCH_MS) / 1000)
+
+
+def estimate_rate(previous_rate, fetched, since_id, oldest_id, now=None):
+
+    """Update a user's posting rate (tweets per day) after a harvest.
+
+    fetched tweets were posted after since_id, or for a first harvest after
+    oldest_id; the rate over that span is blended with the previous estimate."""
+
+    now = now or datetime.datetime.utcnow()
+    start_id = since_id or oldest_id
+    if start_id is None:
+        return previous_rate or 0.0
+    days = max((now - tweet_time(start_id)).total_seconds() / 86400, 1 / 24)
+    rate = fetched / days
+    if previous_rate is None:
+        return rate
+    return RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * previous_rate
+
+
+def poll_interval(rate):
+
+    """How long to leave a user posting at rate tweets/day before polling again."""
+
+    if not rate:
+        return MAX_INTERVAL
+    interval = datetime.timedelta(days=TWEETS_PER_POLL / rate)
+    return max(MIN_INTERVAL, min(MAX_INTERVAL, interval))
+
+
+class PollScheduler:
+
+    """A priority queue of users ordered by when they are next due a harvest.
+
+    Each user's due time is their last harvest plus an interval chosen from
+    their posting rate, so prolific users are polled often enough that no
+    more than about a page of tweets builds up, and dormant ones rarely."""
+
+    def __init__(self, cursor_collection, collection):
+        self.cursors = cursor_collection
+        self.collection = collection
+        self.queue = []
+
+    def load(self, users_to_follow):
+
+        """Queue every user by their due time. Users with no rate estimate yet
+        get one from the tweets already stored for them."""
+
+        now = datetime.datetime.utcnow()
+        cursors = {cursor["_id"]: cursor for cursor in
+                   self.cursors.find({"_id": {"$in": users_to_follow}})}
+        unrated = [twitter_id for twitter_id in users_to_follow
+                   if twitter_id in cursors and cursors[twitter_id].get("rate") is None]
+        for history in self.collection.aggregate([
+                {"$match": {"user.id": {"$in": unrated}}},
+                {"$group": {"_id": "$user.id", "count": {"$sum": 1}, "oldest": {"$min": "$id"}}}]):
+            rate = estimate_rate(None, history["count"], None, history["oldest"], now)
+            cursors[history["_id"]]["rate"] = rate
+            self.cursors.update_one({"_id": history["_id"]}, {"$set": {"rate": rate}})
+
+        self.queue = []
+        for twitter_id in users_to_follow:
+            self.schedule(twitter_id, cursors.get(twitter_id), now)
+
+    def schedule(self, twitter_id, cursor, now=None):
+        now = now or datetime.datetime.utcnow()
+        if cursor is None or cursor.get("last_harvest") is None:
+            due = now
+        elif cursor.get("status") == "error":
+            due = cursor["last_harvest"] + MIN_INTERVAL
+        else:
+            due = cursor["last_harvest"] + poll_interval(cursor.get("rate"))
+        heapq.heappush(self.queue, (due, twitter_id))
+
+    def reschedule(self, twitter_ids):
+
+        """Queue users again after a harvest, from their updated cursors."""
+
+        cursors = {cursor["_id"]: cursor for cursor in
+                   self.cursors.find({"_id": {"$in": list(twitter_ids)}})}
+        for twitter_id in twitter_ids:
+            self.schedule(twitter_id, cursors.get(twitter_id))
+
+    def pop_due(self, now=None):
+
+        """Take every user whose due time has come off the queue."""
+
+        now = now or datetime.datetime.utcnow()
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            due.append(heapq.heappop(self.queue)[1])
+        return due
+
+    def next_due(self):
+        return self.queue[0][0] if self.queue else None
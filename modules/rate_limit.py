@@ -0,0 +1,260 @@
+import collections
+import threading
+import time
+
+import tweepy
+
+from modules import harvest_metrics
+
+
+# Twitter API v1.1 limits for user-authenticated requests, per 15 minute window.
+WINDOW_SECONDS = 15 * 60
+ENDPOINT_LIMITS = {
+    "/statuses/user_timeline": 900,
+    "/users/lookup": 900,
+    "/users/show/:id": 900,
+    "/friends/ids": 15,
+    "/application/rate_limit_status": 180}
+
+# requests failing with these HTTP statuses are tried again, up to RETRIES times
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRIES = 2
+RETRY_DELAY = 5
+
+# the endpoint that each tweepy.API method spends its requests from
+API_METHOD_ENDPOINTS = {
+    "user_timeline": "/statuses/user_timeline",
+    "lookup_users": "/users/lookup",
+    "get_user": "/users/show/:id",
+    "friends_ids": "/friends/ids",
+    "rate_limit_status": "/application/rate_limit_status"}
+
+
+class TokenBucket:
+
+    """A bucket of request tokens for one endpoint.
+
+    Twitter refills the whole allowance at the end of each window rather
+    than continuously, so the bucket does the same: tokens are spent until
+    empty, then callers wait for the reset time and the bucket is refilled."""
+
+    def __init__(self, capacity, window=WINDOW_SECONDS, remaining=None, reset=None):
+        self.capacity = capacity
+        self.window = window
+        self.tokens = capacity if remaining is None else remaining
+        self.reset = time.time() + window if reset is None else reset
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+
+        """Take a token if there is one. Return 0 on success,
+        otherwise the number of seconds until the bucket refills."""
+
+        with self.lock:
+            now = time.time()
+            if now >= self.reset:
+                self.tokens = self.capacity
+                while self.reset <= now:
+                    self.reset += self.window
+            if self.tokens > 0:
+                self.tokens -= 1
+                return 0
+            return self.reset - now
+
+    def sync(self, remaining, reset):
+
+        """Adopt the remaining count and reset time reported by Twitter."""
+
+        with self.lock:
+            self.tokens = min(self.tokens, remaining)
+            self.reset = reset
+
+
+class RateLimiter:
+
+    """One token bucket per endpoint for one credential set,
+    shared by all harvest workers using it."""
+
+    def __init__(self, limits=ENDPOINT_LIMITS, window=WINDOW_SECONDS):
+        self.buckets = {endpoint: TokenBucket(limit, window)
+                        for endpoint, limit in limits.items()}
+
+    def try_acquire(self, endpoint):
+        bucket = self.buckets.get(endpoint)
+        if bucket is None:
+            return 0
+        return bucket.try_acquire()
+
+    def spent(self, endpoint, reset=None):
+
+        """Empty the endpoint's bucket until reset (epoch seconds), eg after a 429."""
+
+        bucket = self.buckets.get(endpoint)
+        if bucket is not None:
+            bucket.sync(0, float(reset) if reset else bucket.reset)
+
+    def seed_from_api(self, api):
+
+        """Start from the budget Twitter says is left in the current windows,
+        so a run that follows closely on another does not overspend."""
+
+        try:
+            status = api.rate_limit_status()
+        except Exception as e:
+            print(f"Could not read rate limit status, assuming full windows: {e}")
+            return
+        for family in status.get("resources", {}).values():
+            for endpoint, window in family.items():
+                if endpoint in self.buckets:
+                    self.buckets[endpoint].sync(window["remaining"], window["reset"])
+
+
+class HarvestStopped(tweepy.TweepError):
+
+    """Raised by a request made after the pool's stop event was set."""
+
+
+class CredentialPool:
+
+    """A set of tweepy.API clients, one per credential set, each with its own
+    RateLimiter and usage counts.
+
+    Calling an API method on the pool (pool.user_timeline(...)) takes a token
+    from a credential with budget left in that endpoint's window and makes the
+    call with its client, waiting only when every credential is spent, so
+    throughput scales with the number of credentials. Attributes that are not
+    rate-limited endpoints are taken from the first client.
+
+    A request that fails with a 429 or a server error is tried again (on
+    whichever credential has budget), up to RETRIES times; after a 429 the
+    credential that got it waits for the reset Twitter gave. Every request's
+    latency, bytes and retries, and time spent waiting for budget, are counted
+    in metrics (a harvest_metrics.HarvestMetrics, by default the process's own).
+
+    Once stop (a threading.Event, if one is set on the pool) is set, requests
+    waiting for budget, and any made after, raise HarvestStopped rather than
+    wait out the window."""
+
+    def __init__(self, apis, limiters=None, metrics=None):
+        self.apis = list(apis)
+        self.limiters = limiters or [RateLimiter() for api in self.apis]
+        self.metrics = metrics or harvest_metrics.process_metrics
+        self.calls = [collections.Counter() for api in self.apis]
+        self.waited = [0.0 for api in self.apis]
+        self.lock = threading.Lock()
+        self.next_member = 0
+        self.stop = None
+
+    def seed(self):
+        for api, limiter in zip(self.apis, self.limiters):
+            limiter.seed_from_api(api)
+
+    def derive(self, make_api, metrics=None):
+
+        """A pool of different clients (eg raw JSON ones) made from this pool's
+        clients by make_api, spending from the same rate limiters. Its requests
+        are counted in metrics if given, otherwise in this pool's."""
+
+        derived = CredentialPool([make_api(api) for api in self.apis], self.limiters, metrics or self.metrics)
+        derived.calls = self.calls
+        derived.waited = self.waited
+        derived.lock = self.lock # which guards calls and waited
+        derived.stop = self.stop
+        return derived
+
+    def acquire(self, endpoint):
+
+        """Take a token for endpoint from some credential, and return its index."""
+
+        waited = 0
+        while True:
+            if self.stop is not None and self.stop.is_set():
+                raise HarvestStopped(f"Harvest stopped before a request to {endpoint}")
+            with self.lock: # start each search at a different credential to spread the load
+                first = self.next_member
+                self.next_member = (self.next_member + 1) % len(self.apis)
+            waits = []
+            for offset in range(len(self.apis)):
+                member = (first + offset) % len(self.apis)
+                wait = self.limiters[member].try_acquire(endpoint)
+                if wait == 0:
+                    with self.lock:
+                        self.calls[member][endpoint] += 1
+                        self.waited[member] += waited
+                    if waited:
+                        self.metrics.wait(endpoint, waited)
+                    return member
+                waits.append(wait)
+            pause = min(min(waits), 5) + 0.1
+            if self.stop is not None:
+                self.stop.wait(pause)
+            else:
+                time.sleep(pause)
+            waited += pause
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        endpoint = API_METHOD_ENDPOINTS.get(name)
+        if endpoint is None:
+            return getattr(self.apis[0], name)
+
+        def pooled_call(*args, **kwargs):
+            retries = 0
+            while True:
+                member = self.acquire(endpoint)
+                started = time.time()
+                try:
+                    result = getattr(self.apis[member], name)(*args, **kwargs)
+                except Exception as e:
+                    self.metrics.request(endpoint, time.time() - started, failed=True)
+                    status = getattr(getattr(e, "response", None), "status_code", None)
+                    if status not in RETRY_STATUSES or retries == RETRIES:
+                        raise
+                    retries += 1
+                    self.metrics.retry(endpoint)
+                    if status == 429:
+                        self.limiters[member].spent(endpoint, e.response.headers.get("x-rate-limit-reset"))
+                    else:
+                        time.sleep(RETRY_DELAY * retries)
+                    continue
+                self.metrics.request(endpoint, time.time() - started, response_size(self.apis[member], result))
+                return result
+
+        return pooled_call
+
+    def usage(self):
+
+        """Requests made per endpoint and seconds spent waiting for budget, per credential."""
+
+        return [{"credential": member, "calls": dict(self.calls[member]), "waited": round(self.waited[member], 1)}
+                for member in range(len(self.apis))]
+
+
+def response_size(api, result):
+
+    """Bytes received for a request: the body itself for raw JSON responses,
+    otherwise the Content-Length of the last response the client received in
+    this thread. A plain tweepy.API keeps one last_response for every thread
+    using it, which with several workers may be another request's, so the
+    bytes of its parsed responses are not counted (0); clients that keep it
+    per thread (http_transport's, fake_twitter's) are counted in full."""
+
+    if isinstance(result, (str, bytes)):
+        return len(result)
+    if isinstance(api, tweepy.API):
+        return 0
+    headers = getattr(getattr(api, "last_response", None), "headers", None) or {}
+    try:
+        return int(headers.get("content-length", 0))
+    except ValueError:
+        return 0
+
+
+def pooled(api):
+
+    """Return api as a CredentialPool, wrapping a single client if need be."""
+
+    if isinstance(api, CredentialPool):
+        return api
+    return CredentialPool([api])
@@ -1,13 +1,35 @@
+import collections
 import datetime
+import json
 import os
 import sys
 import pymongo
 import tweepy
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
+from modules import bulk_writer, cursor_store, db_stats, harvest_journal, harvest_metrics, http_transport, network_ops, poll_scheduler, rate_limit
 
-def get_credentials():
+try: # orjson decodes tweets several times faster, but is optional
+    import orjson
+    decode_json = orjson.loads
+except ImportError:
+    decode_json = json.loads
 
+
+# tweets sent to MongoDB per insert_many round trip
+DEFAULT_BATCH_SIZE = 1000
+
+
+def read_credentials():
+
+    """Read the sets of Twitter API keys in credentials.txt, without verifying them.
+
+    The file can hold more than one set of keys, each set being the same four
+    lines again."""
+
+    credential_sets = []
     credentials = {}
     try:
         with open("credentials.txt") as file:
@@ -16,6 +38,9 @@ def get_credentials():
                 if line and not line.startswith("#"): # take the non-commented lines
                     try:
                         key, val = line.split()
+                        if key.upper() in credentials: # a key seen again starts the next set
+                            credential_sets.append(credentials)
+                            credentials = {}
                         if val:
                             credentials[key.upper()] = val
                     except ValueError: # users might have forgotten to update the credentials template file
@@ -24,33 +49,86 @@ def get_credentials():
     except FileNotFoundError:
         print("Your credentials.txt file doesn't seem to exist here.")
         sys.exit(2)
+    credential_sets.append(credentials)
+    return credential_sets
+
+
+def get_credentials(pool_size=None):
+
+    """Read and verify the Twitter API credentials in credentials.txt.
+
+    Every set of keys is verified, and the returned api is a CredentialPool
+    over all of them, so harvests can spend the rate limits of every set.
+    credentials and auth are those of the first set.
+    With a pool_size, requests go through one shared http_transport.PooledTransport
+    keeping up to pool_size connections alive, rather than tweepy's
+    connection per request."""
+
+    credential_sets = read_credentials()
+
     # verify the given credentials
-    auth = tweepy.OAuthHandler(credentials["CONSUMER_KEY"], credentials["CONSUMER_SECRET"])
-    auth.set_access_token(credentials["ACCESS_TOKEN"], credentials["ACCESS_TOKEN_SECRET"])
-    api = tweepy.API(auth)
-    verify_reply = api.verify_credentials()
-    if verify_reply == False:
-        print("Your Twitter API credentials were rejected - please check them and retry.")
-        sys.exit(129)
-    else:
-        print("Credentials verified by Twitter API.")
-        
-    return credentials, auth, api
+    apis = []
+    for number, credentials in enumerate(credential_sets, 1):
+        auth = tweepy.OAuthHandler(credentials["CONSUMER_KEY"], credentials["CONSUMER_SECRET"])
+        auth.set_access_token(credentials["ACCESS_TOKEN"], credentials["ACCESS_TOKEN_SECRET"])
+        api = tweepy.API(auth)
+        verify_reply = api.verify_credentials()
+        if verify_reply == False:
+            print(f"Your Twitter API credentials (set {number}) were rejected - please check them and retry.")
+            sys.exit(129)
+        apis.append(api)
+    print(f"Credentials verified by Twitter API ({len(apis)} set(s)).")
+    if pool_size:
+        transport = http_transport.PooledTransport(pool_size)
+        apis = [http_transport.PooledTwitterAPI(api.auth, transport) for api in apis]
+
+    return credential_sets[0], apis[0].auth, rate_limit.CredentialPool(apis)
+
+
+def raw_json_api(auth):
+
+    """A tweepy.API that returns response bodies as undecoded JSON text.
+
+    Timelines fetched through this skip building tweepy Status objects; each
+    page is decoded once by decode_json straight into the dicts that go into
+    MongoDB."""
+
+    return tweepy.API(auth, parser=tweepy.parsers.RawParser())
 
 
-def lookup_users(run_folder, screen_names, credentials, auth, api, args):
+def raw_json_client(api):
 
-    """convert twitter screen names into persistent id numbers"""
+    """A client like api (one credential set) that returns timelines as undecoded JSON.
+    Stand-ins for tweepy.API, such as fake_twitter's, make their own."""
+
+    if hasattr(api, "raw_json"):
+        return api.raw_json()
+    return raw_json_api(api.auth)
+
+
+def chunks(l, n):
+
+    """split a list into blocks of n items"""
+
+    for i in range(0, len(l), n):
+        yield l[i:i+n]
+
+
+def lookup_users(run_folder, screen_names, credentials, auth, api, args, screen_name_collection):
+
+    """convert twitter screen names into persistent id numbers
+
+    Resolved names are kept in screen_name_collection (screen name -> id and the
+    last profile seen), so a --refresh only asks Twitter about names that are
+    new to the list. Those are resolved 100 at a time through users/lookup."""
 
-    duplicate_users = []
     not_found = []
 
     with open(run_folder + "/user_list") as file:
         lines = [x.strip() for x in file.readlines()]
         lines = [x for x in lines if x]
-        for line in lines:
-            if lines.count(line) > 1:
-                duplicate_users.append(line)
+    line_counts = collections.Counter(lines)
+    duplicate_users = [line for line in lines if line_counts[line] > 1]
 
     # Write duplicate users to file.
     if len(duplicate_users) > 0:
@@ -61,37 +139,45 @@ def lookup_users(run_folder, screen_names, credentials, auth, api, args):
 
     print(f"Converting user screen names to persistent id numbers...")
 
-    # Count the number of screen names in the input file
-    non_blank_count = 0
-    with open(run_folder + "/user_list") as count_file:
-        print("3")
-        for line in count_file:
-            if line.strip():
-                non_blank_count += 1
-
-    # chunks splits the screen_name list into manageable blocks:
-    def chunks(l, n):
-        # For item i in a range that is a length of l,
-        for i in range(0, len(l), n):
-            # Create an index range for l of n items:
-            yield l[i:i+n]
-
-    # Query twitter with the comma separated list
-    id_list = []        # empty list for id to go into
-    for chunk in list(chunks(screen_names, 42)): # split list into manageable chunks of 42
-        comma_separated_string = ",".join(chunk) # lookup takes a comma-separated list
-        for user in chunk:
-            try:
-                user = api.get_user(screen_name = user)
-                id_list.append(user.id) # get the id and put it in the id_list
-
-            except tweepy.error.TweepError as e:
-                print("5", e)
-                not_found.append(user) # if not found, put user in not found list
+    # screen names are case insensitive, so the store is keyed on lower case
+    known_ids = {}
+    for known in screen_name_collection.find({}, {"id": 1}):
+        known_ids[known["_id"]] = known["id"]
+    unresolved = [name for name in screen_names if name.lower() not in known_ids]
+    print(f"{len(screen_names) - len(unresolved)} screen names already known, looking up {len(unresolved)}.")
 
-    # Write user codes to file.
+    api = rate_limit.pooled(api)
+    now = datetime.datetime.utcnow()
+    for chunk in chunks(unresolved, 100): # users/lookup takes up to 100 names per request
+        try:
+            users = api.lookup_users(screen_names=chunk, include_entities=False)
+        except tweepy.TweepError as e:
+            if e.api_code != 17: # 17 is "no user matches", ie none in this chunk exist
+                print(f"Problem looking up screen names: {e}")
+            users = []
+        writes = []
+        for user in users:
+            known_ids[user.screen_name.lower()] = user.id
+            writes.append(pymongo.ReplaceOne({"_id": user.screen_name.lower()},
+                                               {"_id": user.screen_name.lower(),
+                                                "screen_name": user.screen_name,
+                                                "id": user.id,
+                                                "profile": user._json,
+                                                "last_seen": now},
+                                               upsert=True))
+        if writes:
+            screen_name_collection.bulk_write(writes, ordered=False)
+
+    id_list = []
+    for name in screen_names:
+        if name.lower() in known_ids:
+            id_list.append(known_ids[name.lower()])
+        else:
+            not_found.append(name) # if not found, put user in not found list
+
+    # Write user codes to file, once each (names can differ only in case).
     with open(run_folder + "/user_list.ids", 'w') as id_file:
-        for id in id_list:
+        for id in dict.fromkeys(id_list):
             id_file.write("%s\n" % id)
 
     # Write non-found users to file.
@@ -103,112 +189,472 @@ def lookup_users(run_folder, screen_names, credentials, auth, api, args):
 
 
 def get_tweets(run_folder, twitter_id, empty_users, private_users,
-               credentials, auth, api, client, db, collection):
-
-    """acquire tweets from each user id number and store them in MongoDB"""
-
-    # check if this user history has been acquired
-    if db.tweets.count_documents({"user.id": twitter_id}) > 0:
-        # we already have this user's timeline, just get recent tweets
-        try:
-            print(f"User {twitter_id} is in the database, normal acquisition cycle...")
-            alltweets = []
-            new_tweets = api.user_timeline(id=twitter_id, count=200,
-                                           tweet_mode='extended', exclude_replies=True,
-                                           wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
-            alltweets.extend(new_tweets)
-        except tweepy.TweepError as e:
-            print(f"Not possible to acquire timeline of {twitter_id} : {e}")
+               credentials, auth, api, client, db, collection, statuses_count=None,
+               raw_json=False, journal=None):
+
+    """acquire tweets from each user id number, one page of up to 200 at a time
+
+    A user's cursor holds the newest tweet id already stored. The timeline is
+    paged back from the present until it reaches that id, so a cycle asks only
+    for tweets we don't have, however many were posted since the last one.
+    New users have no cursor and are paged back as far as Twitter allows (~3200).
+
+    This is a generator: each page is yielded as soon as it arrives, so the
+    caller can store it before the next one is requested. Memory stays at one
+    page per worker, and pages stored before an error are kept. The cursor is
+    only updated once the caller has asked for the page after the last one,
+    that is, once every page has been stored.
+    With raw_json, api must be a raw_json_api and pages are lists of tweet dicts.
+    With a journal, the position reached is recorded after every stored page,
+    and an interrupted user is resumed from that position."""
+
+    status = "ok"
+    newest_id = None
+    oldest_id = None
+    tweet_count = 0
+    cursor = None
+    max_id = None
+    progress = journal.progress(twitter_id) if journal is not None else None
+    if progress is not None:
+        since_id = progress["since_id"]
+        newest_id = progress["newest_id"]
+        max_id = progress["max_id"]
+        print(f"Resuming user {twitter_id} below tweet {max_id}...")
     else:
-        # this user isn't in database: get <3200 tweets if possible
-        try:
+        cursor = cursor_store.get_cursor(db.harvest_cursors, collection, twitter_id)
+        since_id = cursor["newest_id"] if cursor and cursor.get("newest_id") else None
+        if since_id:
+            print(f"User {twitter_id} is in the database, normal acquisition cycle...")
+        else:
             print(f"User {twitter_id} is new, deep acquisition cycle...")
-            alltweets = []
-            new_tweets = api.user_timeline(id=twitter_id, count=200,
-                                           tweet_mode="extended", exclude_replies=True,
-                                           wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
-            alltweets.extend(new_tweets) # this gets the first 200 (maximum per request)
 
-            try:
-                oldest = alltweets[-1].id - 1 # this is now the oldest tweet
-                while len(new_tweets) > 0: # so we do it again, going back another 200 tweets
-                    new_tweets = api.user_timeline(id=twitter_id, count=200, max_id=oldest,
-                                                   tweet_mode="extended", exclude_replies=True,
-                                                   wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
-                    alltweets.extend(new_tweets)
-                    oldest = alltweets[-1].id - 1 # this is now the oldest tweet
-
-            except IndexError: # Index error indicates an empty account.
-                print(f"Empty timeline for user {twitter_id} : skipping.")
-                empty_users.append(twitter_id)
-        except tweepy.TweepError as e:
+    try:
+        while True: # each request goes back another 200 tweets (maximum per request)
+            # a 429 comes back to the credential pool, which waits for the reset and counts the wait
+            new_tweets = api.user_timeline(id=twitter_id, count=200, since_id=since_id, max_id=max_id,
+                                           tweet_mode="extended", exclude_replies=True,
+                                           wait_on_rate_limit=False)
+            if raw_json:
+                new_tweets = decode_json(new_tweets)
+            if len(new_tweets) == 0:
+                break
+            if newest_id is None:
+                newest_id = new_tweets[0]["id"] if raw_json else new_tweets[0].id
+            oldest_id = new_tweets[-1]["id"] if raw_json else new_tweets[-1].id
+            tweet_count += len(new_tweets)
+            max_id = oldest_id - 1 # this is now the oldest tweet
+            yield new_tweets
+            if journal is not None: # the caller has stored the page by the time we resume
+                journal.record_page(twitter_id, since_id, newest_id, max_id)
+
+        if newest_id is None and not since_id:
+            print(f"Empty timeline for user {twitter_id} : skipping.")
+            empty_users.append(twitter_id)
+            status = "empty"
+
+    except rate_limit.HarvestStopped: # the journal has the pages stored so far, for the next run
+        print(f"Harvest of {twitter_id} stopped part way.")
+        return
+    except tweepy.RateLimitError as e: # Twitter telling us to chill out
+        print(f"Rate limit reached on {twitter_id}, will retry next cycle: {e}")
+        status = "error"
+    except tweepy.TweepError as e:
+        if e.response is not None and e.response.status_code == 401:
+            print(f"User {twitter_id} has a private timeline : skipping.")
+            private_users.append(twitter_id)
+            status = "private"
+        else:
             print(f"Not possible to acquire timeline of {twitter_id} : {e}")
-        except tweepy.ConnectionResetError as e:
-            print(f"Connection was reset during tweet harvest on {twitter_id}: {e}")
-        except tweepy.RateLimitError as e: # Twitter telling us to chill out
-            print(f"Rate limit reached on {twitter_id}, waiting for cooldown...")
-
-    return alltweets
-
-
-def insert_to_mongodb(alltweets, collection):
-
-    # update the database with the acquired tweets for this user
-    for tweet in alltweets:
+            status = "error"
+
+    rate = None
+    if status == "ok" and progress is None: # a resumed harvest has not seen the whole span
+        rate = poll_scheduler.estimate_rate(cursor.get("rate") if cursor else None,
+                                            tweet_count, since_id, oldest_id)
+    cursor_store.update_cursor(db.harvest_cursors, twitter_id, newest_id, oldest_id, status,
+                               statuses_count, rate)
+    if journal is not None:
+        journal.mark_done([twitter_id], status)
+
+
+def insert_to_mongodb(alltweets, collection, batch_size=DEFAULT_BATCH_SIZE, write_concern=None, writer=None):
+
+    """Insert tweets into MongoDB in unordered batches, skipping duplicates.
+
+    Each batch is one insert_many round trip; being unordered, a tweet that is
+    already stored fails on its own and the rest of the batch still goes in.
+    Returns the number of tweets inserted and the number of duplicates.
+    With an unacknowledged write concern (w=0) the server reports nothing back,
+    so every tweet sent is counted as inserted.
+    With a writer (a BulkWriter) the tweets go through its shared bulk writes,
+    and this waits until they are stored.
+    The tweets inserted are added to the status counters (see db_stats) of
+    the collection's database."""
+
+    if write_concern is not None:
+        collection = collection.with_options(write_concern=write_concern)
+
+    documents = [tweet if isinstance(tweet, dict) else tweet._json for tweet in alltweets]
+    stored = []
+    duplicates = 0
+    if writer is not None:
+        batches = [documents[start:start + batch_size] for start in range(0, len(documents), batch_size)]
+        futures = [writer.submit(collection, [pymongo.InsertOne(document) for document in batch])
+                   for batch in batches]
+        for batch, future in zip(batches, futures):
+            batch_inserted, batch_duplicates, positions = future.result()
+            rejected = set(positions)
+            stored.extend(document for position, document in enumerate(batch) if position not in rejected)
+            duplicates += batch_duplicates
+    else:
+        for start in range(0, len(documents), batch_size):
+            batch = documents[start:start + batch_size]
             try:
-                try:
-                    collection.insert_one(tweet._json, {"$set": tweet._json})
-                except pymongo.errors.DuplicateKeyError:
-                    pass # denies duplicates being added
-            except IndexError:
-                print(f"User {twitter_id} has no tweets to insert.")
+                collection.insert_many(batch, ordered=False)
+                stored.extend(batch)
+            except pymongo.errors.BulkWriteError as e:
+                write_errors = e.details["writeErrors"]
+                batch_duplicates = sum(1 for error in write_errors if error["code"] == 11000)
+                if batch_duplicates < len(write_errors):
+                    raise # something other than duplicates went wrong
+                rejected = {error["index"] for error in write_errors}
+                stored.extend(document for position, document in enumerate(batch) if position not in rejected)
+                duplicates += batch_duplicates
 
+    db_stats.count_tweets(collection.database[db_stats.STATS_COLLECTION], stored, writer)
+    return len(stored), duplicates
 
-def get_friends(run_folder, credentials, auth, api, friend_collection):
 
-    """Get the friend list and put it in MongoDB"""
+def get_friend_ids(api, twitter_id):
 
-    def ask_api_for_friend_list():
+    """Ask the API for the ids a user follows, in pages of up to 5000.
+    Returns None if the list could not be gathered."""
+
+    friend_list = []
+    try:
+        next_cursor = -1
+        while next_cursor != 0: # until twitter says there are no more pages
+            # rate limits and retries are left to the credential pool, which counts them
+            friends, (previous_cursor, next_cursor) = api.friends_ids(
+                id = twitter_id, count = 5000, cursor = next_cursor,
+                wait_on_rate_limit=False)
+            friend_list.extend(friends)
+        print(f"Friends (following) list of {twitter_id} acquired.")
+        return friend_list
+    except tweepy.TweepError as e:
+        print(f"There was a problem gathering friends of {twitter_id}: {e}")
+        return None
+
+
+def store_friends(friend_collection, friends_history_collection, twitter_id, friend_list, friends_count,
+                  writer=None):
+
+    """Replace a user's friend list with a new snapshot, and log what changed.
+
+    The friends document holds the current list as one flat array, written in
+    a single update. friends_history gets one document per change holding only
+    the ids followed and unfollowed since the previous snapshot (the whole list,
+    as "added", the first time). With a writer (a BulkWriter) the writes are
+    queued to it rather than made here."""
+
+    previous = friend_collection.find_one({"user_id": twitter_id}, {"friends": 1}) or {}
+    # lists stored before snapshots were one-element arrays, [[id], [id], ...]
+    old_friends = {friend[0] if isinstance(friend, list) else friend
+                   for friend in previous.get("friends", [])}
+    new_friends = set(friend_list)
+    added = sorted(new_friends - old_friends)
+    removed = sorted(old_friends - new_friends)
+
+    now = datetime.datetime.utcnow()
+    bulk_writer.write(friend_collection,
+                      [pymongo.UpdateOne({"user_id": twitter_id},
+                                         {"$set": {"friends": friend_list,
+                                                   "friends_count": friends_count,
+                                                   "updated": now}},
+                                         upsert=True)],
+                      writer)
+    if added or removed:
+        bulk_writer.write(friends_history_collection,
+                          [pymongo.InsertOne({"user_id": twitter_id, "time": now,
+                                              "added": added, "removed": removed})],
+                          writer)
+    return added, removed
+
+
+def users_with_new_friends(api, users_to_follow, friend_collection):
+
+    """Find which users' friends_count has changed since their list was stored.
+
+    User objects are fetched 100 at a time. Returns a dict of the users whose
+    list should be fetched again (those with no stored list, or a different
+    friends_count), mapped to their current friends_count."""
+
+    stored_counts = {friends["user_id"]: friends.get("friends_count") for friends in
+                     friend_collection.find({"user_id": {"$in": users_to_follow}},
+                                            {"user_id": 1, "friends_count": 1})}
+    changed = {}
+    for chunk in chunks(users_to_follow, 100): # users/lookup takes up to 100 ids per request
         try:
-            for friend in tweepy.Cursor(api.friends_ids, id = twitter_id, count = 5000,
-                                        wait_on_rate_limit=True, wait_on_rate_limit_notify=True,
-                                        retry_count = 3, timeout = 30).pages():
-                friend_list.extend(friend)
-            print(f"Friends (following) list of {twitter_id} acquired.")
+            users = {user.id: user for user in api.lookup_users(user_ids=chunk, include_entities=False)}
         except tweepy.TweepError as e:
-            print(f"There was a problem gathering friends of {twitter_id}: {e}")
-
-
-    users_to_get_friends = [int(line.rstrip("\n")) for line in open(run_folder + "/user_list.ids")]
+            print(f"Could not check friend counts, fetching all of them: {e}")
+            changed.update({twitter_id: None for twitter_id in chunk})
+            continue
+        for twitter_id in chunk:
+            user = users.get(twitter_id)
+            if user is None or twitter_id not in stored_counts or stored_counts[twitter_id] != user.friends_count:
+                changed[twitter_id] = user.friends_count if user is not None else None
+    print(f"{len(changed)} of {len(users_to_follow)} users have a changed friends count.")
+    return changed
+
+
+def get_friends(run_folder, credentials, auth, api, friend_collection, friends_history_collection,
+                full_cycle=False, friend_edges_collection=None, users_to_follow=None,
+                writer=None, stop=None):
+
+    """Get the friend list and put it in MongoDB
+
+    Only users whose friends_count has changed since last time are asked for
+    their list again, unless full_cycle is set. If friend_edges_collection is
+    given, each follow is also kept there as a (user_id, friend_id) document.
+    users_to_follow defaults to every id in user_list.ids; writer (a BulkWriter)
+    and stop (a threading.Event) are as for harvest."""
+
+    api = rate_limit.pooled(api)
+    started = datetime.datetime.now()
+    metrics_before = api.metrics.snapshot()
+    if users_to_follow is None:
+        users_to_follow = [int(line.rstrip("\n")) for line in open(run_folder + "/user_list.ids")]
+    if friend_edges_collection is not None:
+        network_ops.index_friend_edges(friend_edges_collection)
+
+    if full_cycle:
+        friends_counts = dict.fromkeys(users_to_follow)
+    else:
+        friends_counts = users_with_new_friends(api, users_to_follow, friend_collection)
+        if friend_edges_collection is not None: # lists stored before edges were kept need theirs
+            network_ops.add_missing_friend_edges(friend_collection, friend_edges_collection,
+                                                 [twitter_id for twitter_id in users_to_follow
+                                                  if twitter_id not in friends_counts], writer)
 
     print(f"Getting friend lists of users...")
-    for twitter_id in users_to_get_friends:
-        try_count = 0
-        friend_list = []
-        ask_api_for_friend_list()
+    for twitter_id in users_to_follow:
+        if stop is not None and stop.is_set():
+            break
+        if twitter_id not in friends_counts:
+            continue
+        friend_list = get_friend_ids(api, twitter_id)
+        if friend_list is None:
+            continue
 
         # insert to MongoDB
         try:
-            for friend in friend_list:     # insert those into a mongodb collection called "friends"
-                friend_collection.update_one({"user_id": twitter_id}, {"$addToSet": {"friends": [friend]}}, upsert=True)
+            added, removed = store_friends(friend_collection, friends_history_collection, twitter_id,
+                                           friend_list, friends_counts[twitter_id] or len(friend_list), writer)
+            if friend_edges_collection is not None:
+                network_ops.store_friend_edges(friend_edges_collection, twitter_id, friend_list, writer)
+            print(f"User {twitter_id} follows {len(friend_list)}: {len(added)} new, {len(removed)} unfollowed.")
         except Exception as e:
             print(f"Problem putting friend list into MongoDB: {e}")
+    report_run(friend_collection.database, "friends", started, len(users_to_follow), metrics_before, api.metrics)
+
+
+def users_with_new_activity(api, users_to_follow, cursor_collection, empty_users, private_users):
+
+    """Find which users have posted since their last harvest.
+
+    User objects are fetched 100 at a time and their statuses_count and latest
+    tweet compared with the cursor store. Users with no cursor, whose last
+    harvest did not finish, or whose counts have moved are returned (mapped to
+    their current statuses_count) to have their timelines harvested;
+    everyone else is skipped this cycle."""
+
+    cursors = {cursor["_id"]: cursor for cursor in
+               cursor_collection.find({"_id": {"$in": users_to_follow}})}
+    active = {}
+    for chunk in chunks(users_to_follow, 100): # users/lookup takes up to 100 ids per request
+        try:
+            users = {user.id: user for user in api.lookup_users(user_ids=chunk, include_entities=False)}
+        except tweepy.TweepError as e:
+            print(f"Could not check users for new activity, harvesting them all: {e}")
+            users = {}
+            active.update({twitter_id: None for twitter_id in chunk})
+            continue
+        for twitter_id in chunk:
+            user = users.get(twitter_id)
+            cursor = cursors.get(twitter_id)
+            if user is None: # suspended or deleted; the timeline request will say which
+                active[twitter_id] = None
+            elif user.protected and not user.following:
+                private_users.append(twitter_id)
+            elif (cursor is None or cursor.get("status") not in ("ok", "empty")
+                  or cursor.get("statuses_count") != user.statuses_count):
+                active[twitter_id] = user.statuses_count
+            elif (hasattr(user, "status") and user.status.in_reply_to_status_id is None
+                  and user.status.id > (cursor.get("newest_id") or 0)):
+                active[twitter_id] = user.statuses_count
+            elif cursor.get("status") == "empty":
+                empty_users.append(twitter_id)
 
+    print(f"{len(active)} of {len(users_to_follow)} users have new activity to harvest.")
+    return active
 
-def harvest(run_folder, credentials, auth, api, client, db, collection):
 
-    """Get tweet timelines and insert new tweets into MongoDB"""
+def report_run(db, kind, started, user_count, metrics_before, metrics, **details):
+
+    """Store the API metrics of a run in the runs collection, and print where its time went."""
+
+    try:
+        run = harvest_metrics.save_run(db.runs, dict(kind=kind, started=started, user_count=user_count, **details),
+                                       metrics_before, metrics.snapshot())
+    except Exception as e:
+        print(f"Could not store the run's metrics: {e}")
+        return
+    for endpoint, counts in run["endpoints"].items():
+        if counts["requests"]:
+            print(f"{endpoint}: {counts['requests']} requests, median {counts['p50_seconds']}s, "
+                  f"95% within {counts['p95_seconds']}s, {counts['retries']} retried, "
+                  f"{counts['bytes'] / 1e6:.1f}MB, {counts['wait_seconds']:.0f}s waiting for rate limits.")
+
+
+def harvest(run_folder, credentials, auth, api, client, db, collection, workers=1,
+            batch_size=DEFAULT_BATCH_SIZE, write_concern=None, full_cycle=False, raw_json=False,
+            leases=None, users_to_follow=None, stop=None, writer=None, due_batches=None):
+
+    """Get tweet timelines and insert new tweets into MongoDB
+
+    With workers > 1, that many users are harvested at once by a thread pool.
+    All workers share the rate limiters of the credential pool, so they spend
+    the full request budget of each endpoint window without running into 429s.
+    write_concern is a MongoDB "w" value such as "1" or "majority";
+    None leaves the server default. Unless full_cycle is set, users who have
+    not posted since the last harvest are skipped (see users_with_new_activity).
+    raw_json fetches timelines as plain JSON rather than tweepy objects.
+
+    With leases (a work_leases.WorkLeases), the user list is shared with other
+    epicosm.py processes: this one harvests whichever batches it claims, and
+    a batch left by a dead process is picked up again when its lease expires.
+    Otherwise the run is journalled, so an interrupted run is resumed.
+    users_to_follow defaults to every id in user_list.ids.
+    stop is an optional threading.Event: once set, no more users are started,
+    and the run is left for the next one to resume. If it is also the
+    credential pool's stop, users already being harvested stop at their next
+    request rather than waiting for rate limits. writer is an optional BulkWriter that tweets
+    are stored through, shared with whatever else is writing at the time.
+    due_batches, if given, is an iterable of lists of users that are harvested
+    one after another (see harvest_adaptive) in place of users_to_follow all
+    at once; the credential pool is seeded and the journal opened only once
+    for all of them, and the run is reported when the last is done."""
 
     empty_users = []
     private_users = []
-    users_to_follow = [int(line.rstrip("\n")) for line in open(run_folder + "/user_list.ids")]
+    if users_to_follow is None:
+        users_to_follow = [int(line.rstrip("\n")) for line in open(run_folder + "/user_list.ids")]
     now = datetime.datetime.now()
-    print(f"Starting tweet harvest at {now.strftime('%Y-%m-%d_%H:%M:%S')} ...")
+    print(f"Starting tweet harvest at {now.strftime('%Y-%m-%d_%H:%M:%S')} with {workers} worker(s)...")
+
+    if write_concern is not None:
+        write_concern = pymongo.write_concern.WriteConcern(
+            w=int(write_concern) if str(write_concern).isdigit() else write_concern)
+    totals = {"inserted": 0, "duplicates": 0}
+    totals_lock = threading.Lock()
+    start_time = time.time()
+
+    limited_api = rate_limit.pooled(api)
+    limited_api.seed()
+    metrics_before = limited_api.metrics.snapshot()
+    if raw_json:
+        timeline_api = limited_api.derive(raw_json_client)
+    else:
+        timeline_api = limited_api
+
+    def harvest_user(twitter_id, statuses_count, journal):
+        if stop is not None and stop.is_set():
+            return
+        fetched = 0
+        inserted = 0
+        duplicates = 0
+        for page in get_tweets(run_folder, twitter_id, empty_users, private_users,
+                               credentials, auth, timeline_api, client, db, collection,
+                               statuses_count, raw_json, journal):
+            page_inserted, page_duplicates = insert_to_mongodb(page, collection, batch_size, write_concern, writer)
+            fetched += len(page)
+            inserted += page_inserted
+            duplicates += page_duplicates
+        limited_api.metrics.user(twitter_id, fetched, inserted)
+        print(f"User {twitter_id}: {inserted} tweets inserted, {duplicates} duplicates.")
+        with totals_lock:
+            totals["inserted"] += inserted
+            totals["duplicates"] += duplicates
+
+    def harvest_batch(users_to_follow, journal):
+        if full_cycle:
+            statuses_counts = dict.fromkeys(users_to_follow)
+        else:
+            statuses_counts = users_with_new_activity(limited_api, users_to_follow, db.harvest_cursors,
+                                                      empty_users, private_users)
+            unchanged = [twitter_id for twitter_id in users_to_follow if twitter_id not in statuses_counts]
+            cursor_store.mark_checked(db.harvest_cursors, unchanged, 1 - poll_scheduler.RATE_SMOOTHING)
+            if journal is not None:
+                journal.mark_done(unchanged, "unchanged")
+            users_to_follow = [twitter_id for twitter_id in users_to_follow if twitter_id in statuses_counts]
+
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for result in pool.map(lambda twitter_id: harvest_user(twitter_id, statuses_counts[twitter_id], journal),
+                                       users_to_follow):
+                    pass # map re-raises anything a worker raised
+        else:
+            for twitter_id in users_to_follow:
+                harvest_user(twitter_id, statuses_counts[twitter_id], journal)
+
+    def harvest_due(batch, journal):
+        try: # one batch going wrong should not end a run that has days to go
+            harvest_batch(batch, journal)
+        except Exception as e:
+            print(f"Something went wrong harvesting a batch of {len(batch)} users: {e}")
+
     try: ## iterate through this list of ids.
-        for twitter_id in users_to_follow:
-            alltweets = get_tweets(run_folder, twitter_id, empty_users, private_users,
-                                   credentials, auth, api, client, db, collection)
-            insert_to_mongodb(alltweets, collection)
+        if leases is not None:
+            for users in (due_batches if due_batches is not None else [users_to_follow]):
+                leases.seed(users)
+                for batch in leases.claimed_batches():
+                    harvest_batch(batch, None)
+                    if stop is not None and stop.is_set():
+                        break # the unfinished batch goes back to the queue
+        else:
+            # pick up where an interrupted run stopped, if there was one
+            journal = harvest_journal.HarvestJournal(db)
+            pending = journal.open(users_to_follow)
+            if due_batches is None:
+                harvest_batch(pending, journal)
+            else: # an interrupted user is resumed from the journal when they are next due
+                for batch in due_batches:
+                    harvest_due(batch, journal)
+            if stop is None or not stop.is_set():
+                journal.close()
+
+        elapsed = time.time() - start_time
+        print(f"Harvest inserted {totals['inserted']} tweets ({totals['duplicates']} duplicates) "
+              f"in {elapsed:.0f}s, {totals['inserted'] / max(elapsed, 1):.1f} tweets/s.")
+        for usage in limited_api.usage():
+            print(f"Credential set {usage['credential'] + 1}: {usage['calls']}, "
+                  f"waited {usage['waited']}s for rate limits.")
+        transport = getattr(limited_api.apis[0], "transport", None)
+        if transport is not None:
+            connections = transport.stats()
+            print(f"HTTP: {connections['requests']} requests over {connections['connections']} connection(s), "
+                  f"{connections['wire_bytes'] / 1e6:.1f}MB received "
+                  f"({connections['decoded_bytes'] / 1e6:.1f}MB uncompressed).")
+        report_run(db, "harvest", now, len(users_to_follow), metrics_before, limited_api.metrics,
+                   workers=workers, raw_json=raw_json, full_cycle=full_cycle,
+                   inserted=totals["inserted"], duplicates=totals["duplicates"])
+        db_stats.record_run(db[db_stats.STATS_COLLECTION], datetime.datetime.utcfromtimestamp(start_time), users=len(users_to_follow),
+                            inserted=totals["inserted"], duplicates=totals["duplicates"], seconds=round(elapsed))
+
+        if leases is not None: # other workers saw other users, so these lists would be partial
+            print(f"Info: {len(empty_users)} empty and {len(private_users)} private accounts in this worker's batches.")
+            return
 
         if len(empty_users) > 0: # if empty accounts, put into empty users file
             print(f"Info: {len(empty_users)} users have empty accounts (see user_list.empty)")
@@ -225,3 +671,79 @@ def harvest(run_folder, credentials, auth, api, client, db, collection):
     except Exception as e:
         print(f"Something went wrong during harvest: {e}")
 
+
+def harvest_with_friends(run_folder, credentials, auth, api, client, db, collection,
+                         friend_collection, friends_history_collection, friend_edges_collection=None,
+                         users_to_follow=None, stop=None, **harvest_options):
+
+    """Harvest timelines and friend lists at the same time.
+
+    Friends requests and timeline requests are rate limited separately, so
+    run one after the other each leaves the other's budget unused. Here the
+    friend lists are gathered in a thread of their own while the timelines
+    are harvested, both from the same user list and the same credential pool,
+    and all their writes go through one BulkWriter. The run takes about as
+    long as the slower of the two rather than both together. Each keeps its
+    own metrics, so the run recorded for one does not include the other's
+    requests."""
+
+    api = rate_limit.pooled(api)
+    timeline_api = api.derive(lambda client: client, harvest_metrics.HarvestMetrics(parent=api.metrics))
+    friends_api = api.derive(lambda client: client, harvest_metrics.HarvestMetrics(parent=api.metrics))
+    if users_to_follow is None:
+        users_to_follow = [int(line.rstrip("\n")) for line in open(run_folder + "/user_list.ids")]
+    start_time = time.time()
+    writer = bulk_writer.BulkWriter(harvest_options.get("batch_size", DEFAULT_BATCH_SIZE))
+    writer.start()
+    friends_thread = threading.Thread(target=get_friends,
+                                      args=(run_folder, credentials, auth, friends_api,
+                                            friend_collection, friends_history_collection,
+                                            harvest_options.get("full_cycle", False), friend_edges_collection),
+                                      kwargs=dict(users_to_follow=users_to_follow, writer=writer, stop=stop))
+    friends_thread.start()
+    try:
+        harvest(run_folder, credentials, auth, timeline_api, client, db, collection,
+                users_to_follow=users_to_follow, stop=stop, writer=writer, **harvest_options)
+        friends_thread.join()
+    finally:
+        writer.close()
+    print(f"Timelines and friend lists gathered in {time.time() - start_time:.0f}s, "
+          f"with {writer.round_trips} bulk writes to MongoDB.")
+
+
+def harvest_adaptive(run_folder, credentials, auth, api, client, db, collection, until,
+                     users_to_follow=None, stop=None, **harvest_options):
+
+    """Harvest users as each falls due, until the time until (UTC) or until stop is set.
+
+    Rather than every user every few days, each user is polled at an interval
+    suited to how much they post (see poll_scheduler), and the queue of due
+    users is worked through continuously. It is all one harvest run: the
+    credential pool is seeded and the journal opened once, so the request
+    budget carries over from one batch to the next, and each due batch is
+    harvested within that run."""
+
+    if users_to_follow is None:
+        users_to_follow = [int(line.rstrip("\n")) for line in open(run_folder + "/user_list.ids")]
+    scheduler = poll_scheduler.PollScheduler(db.harvest_cursors, collection)
+    scheduler.load(users_to_follow)
+    print(f"Adaptive harvest of {len(users_to_follow)} users until {until.strftime('%Y-%m-%d_%H:%M:%S')} UTC.")
+
+    def due_batches():
+        while datetime.datetime.utcnow() < until and not (stop is not None and stop.is_set()):
+            due = scheduler.pop_due()
+            if due:
+                yield due
+                scheduler.reschedule(due)
+                continue
+            # nobody is due: sleep until the next user is, checking back at least once a minute
+            now = datetime.datetime.utcnow()
+            next_due = scheduler.next_due() or until
+            pause = max(1, min((next_due - now).total_seconds(), (until - now).total_seconds(), 60))
+            if stop is not None:
+                stop.wait(pause)
+            else:
+                time.sleep(pause)
+
+    harvest(run_folder, credentials, auth, api, client, db, collection,
+            users_to_follow=users_to_follow, stop=stop, due_batches=due_batches(), **harvest_options)
@@ -0,0 +1,120 @@
+import datetime
+import os
+import socket
+import threading
+
+import pymongo
+
+
+LEASE_SECONDS = 300      # a batch goes back to the queue if not renewed within this time
+LEASE_BATCH_SIZE = 100   # user ids per batch
+
+
+class WorkLeases:
+
+    """Share a harvest between several epicosm.py processes through MongoDB.
+
+    The user list is split into batches in the harvest_leases collection.
+    Each worker claims a pending batch, or one whose lease has expired, renews
+    its lease from a heartbeat thread while it works, and marks it done at the
+    end. A worker that dies stops renewing, so after LEASE_SECONDS its batch
+    is claimed by another worker."""
+
+    def __init__(self, db, worker_id=None, lease_seconds=LEASE_SECONDS, batch_size=LEASE_BATCH_SIZE):
+        self.leases = db.harvest_leases
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+
+    def seed(self, users_to_follow):
+
+        """Queue the user list as a new round of batches, unless a round is under way.
+
+        The round is recorded in one document, "round", holding its number and
+        how many batches it has. Starting the next round is a single
+        conditional upsert on the number of the last, so when several workers
+        find the last round finished at once only one of them queues the next;
+        the others' upserts are rejected as duplicates. Batches are tagged with
+        their round, and only batches of earlier rounds are removed, so a batch
+        finished meanwhile is never queued again."""
+
+        now = datetime.datetime.utcnow()
+        current = self.leases.find_one({"_id": "round"}) or {"number": 0, "batches": 0}
+        queued = self.leases.count_documents({"round": current["number"]})
+        if queued == 0 and current["number"] and current["started"] > now - datetime.timedelta(seconds=self.lease_seconds):
+            return # the worker that started this round is still queuing its batches
+        if queued and self.leases.count_documents({"round": current["number"], "state": "done"}) < current["batches"]:
+            return
+
+        number = current["number"] + 1
+        user_batches = [users_to_follow[start:start + self.batch_size]
+                        for start in range(0, len(users_to_follow), self.batch_size)]
+        try:
+            self.leases.find_one_and_update({"_id": "round", "number": current["number"]},
+                                            {"$set": {"number": number, "batches": len(user_batches),
+                                                      "started": now, "owner": self.worker_id}},
+                                            upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            return # another worker started this round first
+        self.leases.delete_many({"_id": {"$ne": "round"}, "round": {"$ne": number}})
+        self.leases.insert_many([{"round": number,
+                                  "batch": batch,
+                                  "user_ids": user_ids,
+                                  "state": "pending",
+                                  "owner": None,
+                                  "expires": None}
+                                 for batch, user_ids in enumerate(user_batches)])
+        print(f"Queued {len(user_batches)} batches of users for distributed harvest (round {number}).")
+
+    def claim(self):
+
+        """Take a pending or expired batch, or return None if none are left."""
+
+        now = datetime.datetime.utcnow()
+        return self.leases.find_one_and_update(
+            {"$or": [{"state": "pending"},
+                     {"state": "leased", "expires": {"$lt": now}}]},
+            {"$set": {"state": "leased",
+                      "owner": self.worker_id,
+                      "expires": now + datetime.timedelta(seconds=self.lease_seconds)}},
+            sort=[("round", pymongo.ASCENDING), ("batch", pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER)
+
+    def renew(self, batch_id):
+        self.leases.update_one({"_id": batch_id, "owner": self.worker_id},
+                               {"$set": {"expires": datetime.datetime.utcnow()
+                                         + datetime.timedelta(seconds=self.lease_seconds)}})
+
+    def release(self, batch_id, state):
+        self.leases.update_one({"_id": batch_id, "owner": self.worker_id},
+                               {"$set": {"state": state, "expires": None}})
+
+    def claimed_batches(self):
+
+        """Yield the user ids of each batch this worker claims, until none are left.
+
+        The lease is renewed in the background while the caller works on a
+        batch, and the batch is marked done when the caller asks for the next.
+        If the caller stops early the batch is put straight back in the queue."""
+
+        while True:
+            batch = self.claim()
+            if batch is None:
+                return
+            print(f"Worker {self.worker_id} claimed batch {batch['batch']} ({len(batch['user_ids'])} users).")
+            stop = threading.Event()
+
+            def heartbeat():
+                while not stop.wait(self.lease_seconds / 3):
+                    self.renew(batch["_id"])
+
+            heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+            heartbeat_thread.start()
+            finished = False
+            try:
+                yield batch["user_ids"]
+                finished = True
+            finally:
+                stop.set()
+                heartbeat_thread.join()
+                self.release(batch["_id"], "done" if finished else "pending")
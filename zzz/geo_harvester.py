@@ -6,12 +6,11 @@ import sys
 import signal
 import os
 import time
-from pymongo import MongoClient
 import pymongo
 from urllib3.exceptions import ProtocolError
 
 # local imports
-from modules import mongo_ops, geo_boxes, env_config, csv2liwc, df_cleaning_functions, twitter_ops
+from modules import mongo_ops, geo_boxes, env_config, csv2liwc, df_cleaning_functions, twitter_ops, db_stats, mongodb_config
 
 
 def signal_handler(signal, frame):
@@ -20,6 +19,8 @@ def signal_handler(signal, frame):
 
     if signal == 2:
         print(f"\n\nCtrl-c, ok got it, just a second while I try to exit gracefully...")
+    db_stats.set_process(mongodb_config.stats_collection, "geo", "idle")
+    db_stats.write_status(mongodb_config.stats_collection, env.status_file)
     mongo_ops.stop_mongo(env.db_path)
     sys.exit(0)
 
@@ -35,6 +36,8 @@ class StreamListener(tweepy.StreamListener):
         """Report the connection was successful"""
 
         print("Connected to the Twitter streaming server.")
+        db_stats.set_process(mongodb_config.stats_collection, "geo", "running")
+        db_stats.write_status(mongodb_config.stats_collection, env.status_file)
 
 
     def on_error(self, status_code):
@@ -64,6 +67,7 @@ class StreamListener(tweepy.StreamListener):
 
         # insert new tweet from stream into database
         db.geotweets_collection.insert_one(datajson)
+        db_stats.count_geotweet(mongodb_config.stats_collection, datajson.get("created_at"))
 
 
 if __name__ == "__main__":
@@ -97,8 +101,7 @@ if __name__ == "__main__":
     ## Start instance of stream listener
     stream_listener = StreamListener(api=tweepy.API(wait_on_rate_limit=True))
     stream = tweepy.Stream(auth=auth, listener=stream_listener)
-    client = MongoClient()
-    db = client.geotweets
+    db = mongodb_config.get_client().geotweets
     while True:
         try: # catch connection exceptions. needs logging.
             stream.filter(locations=geo_boxes.boxes)